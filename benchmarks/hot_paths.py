@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Runs the learn and reply benchmarks over a matrix of corpus sizes, word
+# skews and learning modes, each on a fresh brain, and writes one JSON
+# report per run. Without --url, the bundled ArangoDB stand-in is used.
+
+import argparse
+import itertools
+import json
+import sys
+
+from kimchi import bench
+from kimchi.fakearango import FakeArangoServer
+from kimchi.kimchicli import get_brain
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the learn and reply hot paths")
+    parser.add_argument('--url', default=None,
+                        help="Use the ArangoDB server at this URL.")
+    parser.add_argument('--lines', type=int, nargs='+', default=[500, 2000])
+    parser.add_argument('--skew', type=float, nargs='+', default=[0.8, 1.2])
+    parser.add_argument('--vocabulary', type=int,
+                        default=bench.DEF_VOCABULARY)
+    parser.add_argument('--replies', type=int, default=bench.DEF_REPLIES)
+    parser.add_argument('--walker', nargs='+', default=['traversal'],
+                        choices=('traversal', 'random'))
+    parser.add_argument('--concurrency', type=int, default=0)
+    parser.add_argument('--out', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server = FakeArangoServer().start()
+        url = server.url
+
+    reports = []
+    matrix = itertools.product(args.lines, args.skew, (False, True),
+                               args.walker)
+    for i, (lines, skew, bulk, walker) in enumerate(matrix):
+        brain = get_brain({
+            'dbname': '{0}{1}'.format(bench.DEF_DBNAME, i),
+            'url': url,
+            'walker': walker,
+            'concurrency': args.concurrency,
+        })
+        try:
+            report = bench.run_benchmark(
+                brain, lines, args.vocabulary, skew, replies=args.replies,
+                bulk=bulk)
+        finally:
+            brain.close()
+            brain.backend.drop()
+        report['config'] = {
+            'fake': server is not None,
+            'walker': walker,
+            'concurrency': args.concurrency,
+        }
+        reports.append(report)
+        print('{0} lines, skew {1}, {2}, {3}: {4:.1f} lines/s, '
+              '{5:.1f} replies/s'.format(
+                  lines, skew, report['learn']['mode'], walker,
+                  report['learn']['lines_per_second'],
+                  report['reply']['replies_per_second']), file=sys.stderr)
+
+    if server is not None:
+        server.stop()
+    json.dump(reports, args.out, indent=2, sort_keys=True)
+    args.out.write('\n')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares per-call latency of unpooled requests calls against a pooled
+# GenericAPI session, using a local stub HTTP server.
+
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from kimchi.genericapi import GenericAPI
+
+RESPONSE = json.dumps({'error': False, 'result': {}}).encode('utf8')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+
+def unpooled(url, calls):
+    for i in range(calls):
+        r = requests.post(url + '_api/document',
+                          data=json.dumps({'_key': str(i)}))
+        json.loads(r.text)
+
+
+def pooled(url, calls):
+    api = GenericAPI(url)
+    for i in range(calls):
+        api._api.document.post({'_key': str(i)})
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Compare pooled and unpooled HTTP call latency")
+    parser.add_argument('--calls', type=int, default=2000)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{0}/'.format(server.server_port)
+
+    for name, func in (('unpooled', unpooled), ('pooled', pooled)):
+        start = time.perf_counter()
+        func(url, args.calls)
+        elapsed = time.perf_counter() - start
+        print("{0:>9}: {1:8.1f} us/call".format(
+            name, 1e6 * elapsed / args.calls))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the full chain traversal against the sampling random walker on
+# a branching-heavy corpus: a small vocabulary makes most nodes share
+# their successors, so the number of paths grows quickly with length.
+
+import argparse
+import random
+import time
+
+from kimchi.kimchicli import MAX_REPLY_LENGTH, get_brain
+
+
+def corpus(lines, vocabulary, max_words):
+    words = ['word{0}'.format(i) for i in range(vocabulary)]
+    for i in range(lines):
+        yield ' '.join(random.choice(words)
+                       for _ in range(random.randint(1, max_words)))
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Compare chain traversal with random walk sampling")
+    parser.add_argument('--backend', default='arango',
+                        choices=('arango', 'memory'))
+    parser.add_argument('--dbname', default='walkerbench')
+    parser.add_argument('--datadir', default='.')
+    parser.add_argument('--lines', type=int, default=2000)
+    parser.add_argument('--vocabulary', type=int, default=30)
+    parser.add_argument('--max-words', type=int, default=12)
+    parser.add_argument('--seeds', type=int, default=20)
+    parser.add_argument('--samples', type=int, default=10)
+    args = parser.parse_args()
+
+    random.seed(0)
+    brain = get_brain(vars(args))
+    brain.learn_batch(list(corpus(args.lines, args.vocabulary,
+                                  args.max_words)))
+    seeds = []
+    for i in range(args.vocabulary):
+        seeds.extend(brain.get_nodes_by_first_word('word{0}'.format(i)))
+    seeds = random.sample(seeds, min(args.seeds, len(seeds)))
+
+    backend = brain.backend
+    for name, walk in (
+            ('traversal', backend.word_chains),
+            ('random', lambda *a: backend.sample_chains(
+                *a, samples=args.samples))):
+        paths = 0
+        start = time.perf_counter()
+        for seed in seeds:
+            for direction in ('outbound', 'inbound'):
+                paths += len(walk(seed, direction, brain.stop,
+                                  MAX_REPLY_LENGTH))
+        elapsed = time.perf_counter() - start
+        print("{0:>9}: {1:8.2f} ms/walk, {2:8.1f} paths/walk".format(
+            name, 1e3 * elapsed / (2 * len(seeds)),
+            paths / (2 * len(seeds))))
+    brain.close()
+
+
+if __name__ == '__main__':
+    run()
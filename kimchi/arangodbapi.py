@@ -15,13 +15,20 @@
 from kimchi.genericapi import GenericAPI as Connector
 from hashlib import sha1
 
+# errorNum values from the server's error responses
+ERROR_DOCUMENT_NOT_FOUND = 1202
+ERROR_COLLECTION_NOT_FOUND = 1203
+ERROR_DUPLICATE_NAME = 1207
+ERROR_UNIQUE_CONSTRAINT_VIOLATED = 1210
+
 
 class ArangoError(Exception):
-    def __init__(self, code, errmsg, path, data=None):
+    def __init__(self, code, errmsg, path, data=None, num=None):
         self.code = code
         self.errmsg = errmsg
         self.path = path
         self.data = data
+        self.num = num
 
 
 class Arango(object):
@@ -33,7 +40,8 @@ class Arango(object):
             raise ArangoError(code=resp['code'],
                               errmsg=resp['errorMessage'],
                               path=self.conn.the_url,
-                              data=data)
+                              data=data,
+                              num=resp.get('errorNum'))
 
     def create(self, data, params=None):
         if params is None:
@@ -79,6 +87,45 @@ class DatabaseManagement(Arango):
         self.conn = conn._api.database
 
 
+class Collection(Arango):
+    def __init__(self, conn):
+        self.conn = conn._api.collection
+
+    def ensure(self, name, edges=False):
+        try:
+            return self.create({'name': name, 'type': 3 if edges else 2})
+        except ArangoError as e:
+            if e.num != ERROR_DUPLICATE_NAME:
+                raise
+
+
+class Index(Arango):
+    def __init__(self, conn):
+        self.conn = conn._api.index
+
+    def ensure_hash_index(self, collection, fields, unique=False,
+                          sparse=False):
+        # returns the existing index if there is one
+        data = {
+            'type': 'hash',
+            'fields': fields,
+            'unique': unique,
+            'sparse': sparse,
+        }
+        return self.create(data, params={'collection': collection})
+
+    def ensure_persistent_index(self, collection, fields, unique=False,
+                                sparse=False):
+        # returns the existing index if there is one
+        data = {
+            'type': 'persistent',
+            'fields': fields,
+            'unique': unique,
+            'sparse': sparse,
+        }
+        return self.create(data, params={'collection': collection})
+
+
 class Document(Arango):
     def __init__(self, conn):
         self.conn = conn._api.document
@@ -89,13 +136,25 @@ class Edge(Arango):
         self.conn = conn._api.edge
 
 
+class Edges(Arango):
+    def __init__(self, conn):
+        self.conn = conn._api.edges
+
+    def edges(self, collection, vertex, direction='any', timeout=None):
+        params = {'vertex': vertex, 'direction': direction}
+        resp = self.conn[collection].get(params=params, timeout=timeout)
+        self._check_exception_required(resp, params)
+        return resp['edges']
+
+
 class Traversal(Arango):
     def __init__(self, conn):
         self.conn = conn._api.traversal
 
     def traverse(self, startVertex, edge_collection, minDepth=None,
                  maxDepth=None, direction='outbound', visitor=None,
-                 filterfn=None, maxIterations=None, params=None):
+                 filterfn=None, maxIterations=None, params=None,
+                 timeout=None):
         data = {
             'startVertex': startVertex,
             'edgeCollection': edge_collection,
@@ -114,25 +173,99 @@ class Traversal(Arango):
             data['maxIterations'] = maxIterations
         if params is None:
             params = {}
-        return self.conn.post(data, params=params)
+        return self.conn.post(data, params=params, timeout=timeout)
+
+
+class BulkImport(Arango):
+    def __init__(self, conn):
+        self.conn = conn._api['import']
+
+    def import_documents(self, collection, documents, on_duplicate='error',
+                         edges=False, params=None):
+        if params is None:
+            params = {}
+        params.update({
+            'collection': collection,
+            'type': 'list',
+            'createCollection': 'true',
+            'onDuplicate': on_duplicate,
+        })
+        if edges:
+            params['createCollectionType'] = 'edge'
+        resp = self.conn.post(documents, params=params)
+        self._check_exception_required(resp, {'collection': collection})
+        return resp
+
+
+class Cursor(Arango):
+    def __init__(self, conn):
+        self.conn = conn._api.cursor
+
+    def query(self, query, bind_vars=None, batch_size=None, timeout=None):
+        data = {'query': query}
+        if bind_vars is not None:
+            data['bindVars'] = bind_vars
+        if batch_size is not None:
+            data['batchSize'] = batch_size
+        resp = self.conn.post(data, timeout=timeout)
+        return self.results(resp, data, timeout=timeout)
+
+    def results(self, resp, data=None, timeout=None):
+        # yields a page at a time; closing the generator early deletes the
+        # cursor on the server rather than leaving it to time out
+        self._check_exception_required(resp, data)
+        try:
+            yield from resp['result']
+            while resp['hasMore']:
+                resp = self.conn[resp['id']].put(timeout=timeout)
+                self._check_exception_required(resp, data)
+                yield from resp['result']
+        except GeneratorExit:
+            if resp.get('hasMore'):
+                self.conn[resp['id']].delete(timeout=timeout)
+            raise
+
 
 class SimpleQuery(Arango):
     def __init__(self, conn):
         self.conn = conn._api.simple
-        self.cursor = conn._api.cursor
+        self.cursor = Cursor(conn)
 
-    def by_example(self, collection, example, limit=None):
+    def iter_by_example(self, collection, example, limit=None,
+                        batch_size=None, timeout=None):
         data = {
             'collection': collection,
             'example': example,
         }
         if limit is not None:
             data['limit'] = limit
+        if batch_size is not None:
+            data['batchSize'] = batch_size
+
+        resp = self.conn['by-example'].put(data, timeout=timeout)
+        return self.cursor.results(resp, data, timeout=timeout)
 
-        resp = self.conn['by-example'].put(data)
-        results = resp['result']
-        while resp['hasMore']:
-            resp = self.cursor[resp['id']].put()
-            results.append(resp['result'])
-        return results
+    def by_example(self, collection, example, limit=None, batch_size=None,
+                   timeout=None):
+        return list(self.iter_by_example(collection, example, limit,
+                                         batch_size, timeout))
+
+    def all(self, collection, batch_size=None):
+        data = {
+            'collection': collection,
+        }
+        if batch_size is not None:
+            data['batchSize'] = batch_size
+
+        resp = self.conn.all.put(data)
+        return self.cursor.results(resp, data)
+
+    def lookup_by_keys(self, collection, keys, timeout=None):
+        data = {
+            'collection': collection,
+            'keys': keys,
+        }
+        resp = self.conn['lookup-by-keys'].put(data, timeout=timeout)
+        self._check_exception_required(resp, data)
+        return resp['documents']
 
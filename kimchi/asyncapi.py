@@ -0,0 +1,48 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEF_CONCURRENCY = 8
+
+
+class AsyncTransport(object):
+    # runs blocking GenericAPI calls on a bounded pool of threads so that
+    # they can be awaited concurrently; the GenericAPI session pool should
+    # be at least as large as the concurrency limit
+    def __init__(self, concurrency=DEF_CONCURRENCY):
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def call(self, func, *args, **kwargs):
+        # calls still queued when they are cancelled never start, so that
+        # abandoned searches do not tie up the threads
+        cancelled = threading.Event()
+
+        def run():
+            if not cancelled.is_set():
+                return func(*args, **kwargs)
+
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self.executor, run)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
@@ -0,0 +1,795 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Storage backends for a Brain.
+#
+# A backend stores chain nodes (the documents built by Brain.make_nodes),
+# the links between them and the brain's control information. Nodes are
+# referred to by opaque handles returned from add_nodes and import_nodes.
+
+import os
+import pickle
+import random
+import time
+from array import array
+from collections import Counter
+from hashlib import sha1
+
+from kimchi.arangodbapi import (ERROR_DUPLICATE_NAME,
+                                ERROR_UNIQUE_CONSTRAINT_VIOLATED, Arango,
+                                ArangoError, BulkImport, Collection, Cursor,
+                                Document, Edge, Edges, Index, SimpleQuery,
+                                Traversal)
+from kimchi.genericapi import DEF_POOL_SIZE, GenericAPI as Connector, Timeout
+from kimchi.walker import DEF_CHAIN_SAMPLES, sample_chains
+
+DEF_URL = 'http://127.0.0.1:8529'
+DEF_DATADIR = '.'
+MAX_CHAIN_PATHS = 1000
+# how many nodes a chain search visits between checks of its timeout
+CHECK_INTERVAL = 1000
+MAX_PREFIX_NODES = 100
+WRITE_BATCH_SIZE = 10000
+
+# node keys are sha1 hashes, so the stem's nodes from a random key on,
+# wrapping round to the first, are a random sample read straight from the
+# stem and key index
+SAMPLE_BY_STEM = (
+    "LET after = (FOR n IN @@collection FILTER n.base_word_stem == @stem "
+    "&& n._key >= @start SORT n._key LIMIT @limit RETURN n._id) "
+    "LET before = (FOR n IN @@collection FILTER n.base_word_stem == @stem "
+    "&& n._key < @start SORT n._key LIMIT @limit RETURN n._id) "
+    "FOR id IN SLICE(APPEND(after, before), 0, @limit) RETURN id")
+ADD_COUNTS = (
+    "FOR c IN @counts UPSERT {_key: c._key} INSERT c "
+    "UPDATE {count: OLD.count + c.count} IN @@collection")
+UPSERT_NODES = (
+    "FOR n IN @nodes UPSERT {_key: n._key} INSERT n "
+    "UPDATE {outbound_distance: MIN([OLD.outbound_distance, "
+    "n.outbound_distance]), inbound_distance: MIN([OLD.inbound_distance, "
+    "n.inbound_distance]), count: OLD.count + n.count, "
+    "seen: MAX([OLD.seen, n.seen])} IN @@collection")
+UPSERT_LINKS = (
+    "FOR e IN @links UPSERT {_key: e._key} INSERT e "
+    "UPDATE {count: OLD.count + e.count, seen: MAX([OLD.seen, e.seen])} "
+    "IN @@collection")
+# a full prefix is a reservoir sample of the nodes it was seen on: each new
+# node in slots takes the place of the node in the same slot with the
+# chance a reservoir would give it, weighted for the nodes left out of
+# slots when a batch brings more than fit
+ADD_PREFIXES = (
+    "FOR p IN @prefixes UPSERT {_key: p._key} "
+    "INSERT {_key: p._key, prefix: p.prefix, count: p.count, "
+    "nodes: p.nodes} "
+    "UPDATE {count: OLD.count + p.count, nodes: "
+    "LENGTH(UNION_DISTINCT(OLD.nodes, p.nodes)) <= @limit "
+    "? UNION_DISTINCT(OLD.nodes, p.nodes) "
+    ": (FOR i IN 0..@limit - 1 "
+    "LET n = POSITION(OLD.nodes, p.slots[i]) ? null : p.slots[i] "
+    "FILTER OLD.nodes[i] != null || n != null "
+    "RETURN n != null && (OLD.nodes[i] == null || "
+    "RAND() * (OLD.count + p.count) < @limit * p.weight) "
+    "? n : OLD.nodes[i])} IN @@collection")
+# documents are only changed by compaction if they have not been seen again
+# since they were read
+REMOVE_UNSEEN = (
+    "FOR d IN @docs FOR n IN @@collection "
+    "FILTER n._key == d._key && n.seen == d.seen REMOVE n IN @@collection")
+SET_DISTANCES = (
+    "FOR d IN @docs FOR n IN @@collection "
+    "FILTER n._key == d._key && n.seen == d.seen "
+    "UPDATE n WITH {outbound_distance: d.outbound_distance, "
+    "inbound_distance: d.inbound_distance} IN @@collection")
+REMOVE_KEYS = (
+    "FOR k IN @keys REMOVE {_key: k} IN @@collection "
+    "OPTIONS {ignoreErrors: true}")
+REMOVE_PREFIX_NODES = (
+    "FOR p IN @prefixes FOR n IN @@collection FILTER n._key == p._key "
+    "UPDATE n WITH {nodes: MINUS(n.nodes, p.nodes)} IN @@collection")
+
+DISTANCES = ('outbound_distance', 'inbound_distance')
+
+
+def count_key(kind, value):
+    return sha1('{0}:{1}'.format(kind, value).encode('utf8')).hexdigest()
+
+
+def unique(items):
+    return list(dict.fromkeys(items))
+
+
+def merge_node(nodes, key, doc):
+    # a node keeps its smallest distances and adds up how often it was used
+    known = nodes.get(key)
+    if known is None:
+        nodes[key] = doc
+        return
+    for dist in DISTANCES:
+        known[dist] = min(known[dist], doc[dist])
+    known['count'] += doc['count']
+    known['seen'] = max(known['seen'], doc['seen'])
+
+
+def count_links(links):
+    # each distinct link with how often it was used, seen now
+    seen = int(time.time())
+    return [(from_handle, to_handle, count, seen)
+            for (from_handle, to_handle), count in Counter(links).items()]
+
+
+def batched(items, size=WRITE_BATCH_SIZE):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def find_chains(handle, links, first_word, stop_word, max_length,
+                timeout=None, visited=None):
+    # enumerates the paths of up to max_length links from handle that end
+    # at a node starting with stop_word, as lists of handles without the
+    # final node, giving up like a request would after timeout seconds.
+    # Every node searched is added to visited if it is given.
+    deadline = None if timeout is None else time.time() + timeout
+    paths = []
+    stack = [(handle, (handle,))]
+    searched = 0
+    while stack and len(paths) < MAX_CHAIN_PATHS:
+        searched += 1
+        if (deadline is not None and not searched % CHECK_INTERVAL and
+                time.time() >= deadline):
+            raise Timeout("chain search timed out")
+        node, path = stack.pop()
+        if visited is not None:
+            visited.add(node)
+        if first_word(node) == stop_word:
+            paths.append(path[:-1])
+        if len(path) > max_length:
+            continue
+        for next_node in links(node):
+            if next_node not in path:
+                stack.append((next_node, path + (next_node,)))
+    return paths
+
+
+class ArangoBackend(object):
+    collection_name = "chains"
+    edge_collection_name = "links"
+    control_collection_name = "control"
+    stats_collection_name = "stats"
+    pools_collection_name = "pools"
+    prefix_collection_name = "prefixes"
+
+    def __init__(self, dbname="chains", url=DEF_URL,
+                 pool_size=DEF_POOL_SIZE, conn=None):
+        # brains in the same process can share a connection
+        if conn is None:
+            conn = Connector(url, pool_size=pool_size)
+        self.conn = conn
+        self.dbname = dbname
+        sysdb = Arango(conn._db._system._api.database)
+        try:
+            sysdb.create({'name': dbname})
+        except ArangoError as e:
+            if e.num != ERROR_DUPLICATE_NAME:
+                raise
+        db = conn._db[dbname]
+        self.docs = Document(db)
+        self.edges = Edge(db)
+        self.simple_query = SimpleQuery(db)
+        self.traversal = Traversal(db)
+        self.bulk_import = BulkImport(db)
+        self.vertex_edges = Edges(db)
+        self.cursor = Cursor(db)
+
+        collections = Collection(db)
+        collections.ensure(self.collection_name)
+        collections.ensure(self.edge_collection_name, edges=True)
+        collections.ensure(self.control_collection_name)
+        collections.ensure(self.stats_collection_name)
+        collections.ensure(self.pools_collection_name)
+        collections.ensure(self.prefix_collection_name)
+        # seed lookups read a range of keys for the stem
+        Index(db).ensure_persistent_index(self.collection_name,
+                                          ['base_word_stem', '_key'])
+        self.info = None
+
+    def close(self):
+        pass
+
+    def drop(self):
+        # deletes the whole database
+        Arango(self.conn._db._system._api.database).delete(self.dbname)
+
+    def load_info(self):
+        return {doc['_key']: doc['value'] for doc in
+                self.simple_query.all(self.control_collection_name)}
+
+    def get_or_set_info(self, key, value):
+        # the control info is read in one go and then kept
+        if self.info is None:
+            self.info = self.load_info()
+        if key in self.info:
+            return self.info[key]
+        try:
+            self.docs.create(
+                {'_key': key, 'value': value},
+                params={'collection': self.control_collection_name,
+                        'createCollection': True})
+        except ArangoError as e:
+            # another brain set it first
+            if e.num != ERROR_UNIQUE_CONSTRAINT_VIOLATED:
+                raise
+            self.info = self.load_info()
+            return self.info[key]
+        self.info[key] = value
+        return value
+
+    def get_info(self, key, default=None):
+        if self.info is None:
+            self.info = self.load_info()
+        return self.info.get(key, default)
+
+    def set_info(self, key, value):
+        self.bulk_import.import_documents(
+            self.control_collection_name, [{'_key': key, 'value': value}],
+            on_duplicate='replace')
+        if self.info is not None:
+            self.info[key] = value
+
+    def edge_key(self, from_handle, to_handle):
+        # the sha1 of str((from_handle, to_handle)), which handles need no
+        # quoting in
+        return sha1("('{0}', '{1}')".format(from_handle, to_handle)
+                    .encode('utf8')).hexdigest()
+
+    def node_handle(self, key):
+        return '{0}/{1}'.format(self.collection_name, key)
+
+    def get_node_by_handle(self, handle):
+        return self.docs[handle]
+
+    def get_node_by_key(self, key):
+        return self.docs[self.collection_name][key]
+
+    def get_edge_by_handle(self, handle):
+        return self.edges[handle]
+
+    def get_edge_by_key(self, key):
+        return self.docs[self.edge_collection_name][key]
+
+    def add_nodes(self, nodes):
+        merged = {}
+        for doc in nodes:
+            merge_node(merged, doc['_key'], dict(doc))
+        handles = self.import_nodes(merged)
+        return [handles[doc['_key']] for doc in nodes]
+
+    def add_edges(self, handles):
+        self.import_edges(count_links(zip(handles, handles[1:])))
+
+    def import_nodes(self, nodes):
+        # new nodes are inserted and known ones keep their smallest
+        # distances and add to their usage, all in one query
+        if nodes:
+            bind_vars = {'@collection': self.collection_name,
+                         'nodes': list(nodes.values())}
+            for result in self.cursor.query(UPSERT_NODES, bind_vars):
+                pass
+        return {key: self.node_handle(key) for key in nodes}
+
+    def import_edges(self, edges):
+        # edges are (from, to, count, seen), and links already known add to
+        # their usage
+        documents = {}
+        for from_handle, to_handle, count, seen in edges:
+            key = self.edge_key(from_handle, to_handle)
+            known = documents.get(key)
+            if known is None:
+                documents[key] = {'_key': key, '_from': from_handle,
+                                  '_to': to_handle, 'count': count,
+                                  'seen': seen}
+            else:
+                known['count'] = (known['count'] or 0) + (count or 0)
+                known['seen'] = max(known['seen'] or 0, seen or 0) or None
+        if documents:
+            bind_vars = {'@collection': self.edge_collection_name,
+                         'links': list(documents.values())}
+            for result in self.cursor.query(UPSERT_LINKS, bind_vars):
+                pass
+
+    def iter_nodes(self):
+        for doc in self.simple_query.all(self.collection_name):
+            yield doc['_id'], doc
+
+    def iter_edges(self):
+        for doc in self.simple_query.all(self.edge_collection_name):
+            yield doc['_from'], doc['_to']
+
+    def iter_links(self):
+        # the links with their usage, which is None if never recorded
+        for doc in self.simple_query.all(self.edge_collection_name):
+            yield doc['_from'], doc['_to'], doc.get('count'), doc.get('seen')
+
+    def update(self, query, collection, docs):
+        for batch in batched(docs):
+            bind_vars = {'@collection': collection, 'docs': batch}
+            for result in self.cursor.query(query, bind_vars):
+                pass
+
+    def set_distances(self, distances):
+        # distances are {handle: (outbound, inbound, seen)}
+        self.update(SET_DISTANCES, self.collection_name, [
+            {'_key': handle.split('/', 1)[1], 'outbound_distance': outbound,
+             'inbound_distance': inbound, 'seen': seen}
+            for handle, (outbound, inbound, seen) in distances.items()])
+
+    def prune(self, nodes, edges, prefixes):
+        # nodes are {handle: seen}, edges {(from, to): seen} and must
+        # include every link of the nodes, and prefixes {prefix: handles}
+        # the nodes are dropped from
+        self.update(REMOVE_UNSEEN, self.edge_collection_name, [
+            {'_key': self.edge_key(from_handle, to_handle), 'seen': seen}
+            for (from_handle, to_handle), seen in edges.items()])
+        self.update(REMOVE_UNSEEN, self.collection_name, [
+            {'_key': handle.split('/', 1)[1], 'seen': seen}
+            for handle, seen in nodes.items()])
+        for batch in batched(prefixes.items()):
+            bind_vars = {'@collection': self.prefix_collection_name,
+                         'prefixes': [{'_key': count_key('prefix', prefix),
+                                       'nodes': handles}
+                                      for prefix, handles in batch]}
+            for result in self.cursor.query(REMOVE_PREFIX_NODES, bind_vars):
+                pass
+
+    def nodes_by_stem(self, stem, limit, timeout=None):
+        # a random sample drawn on the server through the stem index
+        bind_vars = {
+            '@collection': self.collection_name,
+            'stem': stem,
+            'start': '{0:040x}'.format(random.getrandbits(160)),
+            'limit': limit,
+        }
+        handles = list(self.cursor.query(SAMPLE_BY_STEM, bind_vars,
+                                         batch_size=limit, timeout=timeout))
+        random.shuffle(handles)
+        return handles
+
+    def add_counts(self, words, stems):
+        # word and stem counts are added to in a single query
+        counts = [
+            {'_key': count_key(kind, value), 'kind': kind, 'value': value,
+             'count': count}
+            for kind, counter in (('word', words), ('stem', stems))
+            for value, count in counter.items()]
+        if counts:
+            bind_vars = {'@collection': self.stats_collection_name,
+                         'counts': counts}
+            for result in self.cursor.query(ADD_COUNTS, bind_vars):
+                pass
+
+    def load_counts(self):
+        counts = {'word': {}, 'stem': {}}
+        for doc in self.simple_query.all(self.stats_collection_name):
+            counts[doc['kind']][doc['value']] = doc['count']
+        return counts['word'], counts['stem']
+
+    def load_pools(self):
+        return {doc['stem']: doc['replies'] for doc in
+                self.simple_query.all(self.pools_collection_name)}
+
+    def store_pools(self, pools):
+        documents = [{'_key': count_key('pool', stem), 'stem': stem,
+                      'replies': replies}
+                     for stem, replies in pools.items()]
+        if documents:
+            self.bulk_import.import_documents(
+                self.pools_collection_name, documents,
+                on_duplicate='replace')
+
+    def discard_pools(self, stems):
+        bind_vars = {'@collection': self.pools_collection_name,
+                     'keys': [count_key('pool', stem) for stem in stems]}
+        for result in self.cursor.query(REMOVE_KEYS, bind_vars):
+            pass
+
+    def add_prefixes(self, prefixes):
+        # each prefix keeps a sample of up to MAX_PREFIX_NODES of the nodes
+        # it was seen on, and each batch offers a sample of its own nodes in
+        # random slots
+        documents = []
+        for prefix, (count, handles) in prefixes.items():
+            handles = unique(handles)
+            nodes = random.sample(handles, min(len(handles),
+                                               MAX_PREFIX_NODES))
+            slots = [None] * MAX_PREFIX_NODES
+            for slot, handle in zip(random.sample(range(MAX_PREFIX_NODES),
+                                                  len(nodes)), nodes):
+                slots[slot] = handle
+            documents.append({
+                '_key': count_key('prefix', prefix), 'prefix': prefix,
+                'count': count, 'nodes': nodes, 'slots': slots,
+                'weight': len(handles) / len(nodes)})
+        if documents:
+            bind_vars = {'@collection': self.prefix_collection_name,
+                         'prefixes': documents, 'limit': MAX_PREFIX_NODES}
+            for result in self.cursor.query(ADD_PREFIXES, bind_vars):
+                pass
+
+    def nodes_by_prefix(self, prefixes, timeout=None):
+        docs = self.simple_query.lookup_by_keys(
+            self.prefix_collection_name,
+            [count_key('prefix', prefix) for prefix in prefixes],
+            timeout=timeout)
+        return {doc['prefix']: (doc['count'], doc['nodes']) for doc in docs}
+
+    def word_chains(self, handle, direction, stop, max_length, timeout=None,
+                    visited=None):
+        # the handles of the vertices visited are added to visited if given
+        visitor = """
+            if (! result || ! result.visited) { return; }
+            if (result.visited.vertices) {
+              result.visited.vertices.push(vertex._id);
+            }
+            if (result.visited.paths) {
+              var cpath = [];
+              path.vertices.forEach(function (v) {
+                cpath.push(v.node[0]);
+              });
+              result.visited.paths.push(cpath);
+            }
+        """
+
+        filterfn = """
+            if (path && path.length + vertex.%s > %d) {
+              return 'exclude';
+            }
+        """ % (direction + "_distance", max_length)
+
+        result = self.traversal.traverse(
+            handle,
+            self.edge_collection_name,
+            direction=direction,
+            maxDepth=max_length,
+            filterfn=filterfn,
+            visitor=visitor,
+            timeout=timeout)
+
+        if 'result' not in result:
+            return []
+        if visited is not None:
+            visited.update(result['result']['visited']['vertices'])
+        paths = result['result']['visited']['paths']
+        returnpaths = [p[:-1] for p in paths if p[-1] == stop]
+        return returnpaths
+
+    def sample_chains(self, handle, direction, stop, max_length,
+                      samples=DEF_CHAIN_SAMPLES, timeout=None):
+        # nodes and neighbour lists are fetched once per call as the walks
+        # reach them
+        collection = self.collection_name
+        edge_direction = 'out' if direction == 'outbound' else 'in'
+        end = '_to' if direction == 'outbound' else '_from'
+        distance_key = direction + '_distance'
+        docs = {}
+        links = {}
+
+        def fetch(handles):
+            keys = [h.split('/', 1)[1] for h in handles if h not in docs]
+            if keys:
+                for doc in self.simple_query.lookup_by_keys(
+                        collection, keys, timeout=timeout):
+                    docs[doc['_id']] = doc
+
+        def neighbours(node):
+            if node not in links:
+                links[node] = [e[end] for e in self.vertex_edges.edges(
+                    self.edge_collection_name, node, edge_direction,
+                    timeout=timeout)]
+                fetch(links[node])
+            return links[node]
+
+        fetch([handle])
+        paths = sample_chains(
+            handle, neighbours, lambda node: docs[node][distance_key],
+            lambda node: docs[node]['node'][0], stop, max_length, samples)
+        return [[docs[n]['node'][0] for n in path] for path in paths]
+
+
+class MemoryBackend(object):
+    # Nodes are numbered from 0 and stored as tuples of interned word ids,
+    # with their distances, usage and links held in integer arrays. The
+    # usage of each link is held alongside it in its node's successors.
+    # The whole brain is pickled to a local file when closed.
+    def __init__(self, dbname="chains", datadir=DEF_DATADIR, path=None):
+        if path is None:
+            path = os.path.join(datadir, dbname + '.brain')
+        self.path = path
+        self.info = {}
+        self.words = []
+        self.word_ids = {}
+        self.node_ids = {}
+        self.node_words = []
+        self.outbound_distance = array('l')
+        self.inbound_distance = array('l')
+        # usage, with a count and seen time of 0 where never recorded
+        self.node_counts = array('l')
+        self.node_seen = array('l')
+        self.successors = []
+        self.predecessors = []
+        self.link_counts = []
+        self.link_seen = []
+        self.stems = {}
+        self.word_counts = Counter()
+        self.stem_counts = Counter()
+        self.pools = {}
+        self.prefixes = {}
+        self.dirty = False
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.__dict__.update(pickle.load(f))
+            self.fill_usage()
+
+    def fill_usage(self):
+        # brains saved before usage was recorded have none
+        missing = len(self.node_words) - len(self.node_counts)
+        self.node_counts.extend([0] * missing)
+        self.node_seen.extend([0] * missing)
+        for successors in self.successors[len(self.link_counts):]:
+            self.link_counts.append(array('l', [0] * len(successors)))
+            self.link_seen.append(array('l', [0] * len(successors)))
+
+    def save(self):
+        state = dict(self.__dict__)
+        del state['path'], state['dirty']
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+    def close(self):
+        if self.dirty:
+            self.save()
+
+    def drop(self):
+        # deletes the brain file, and nothing is saved on closing
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.dirty = False
+
+    def get_or_set_info(self, key, value):
+        if key not in self.info:
+            self.info[key] = value
+            self.dirty = True
+        return self.info[key]
+
+    def load_info(self):
+        return dict(self.info)
+
+    def get_info(self, key, default=None):
+        return self.info.get(key, default)
+
+    def set_info(self, key, value):
+        self.info[key] = value
+        self.dirty = True
+
+    def word_id(self, word):
+        wid = self.word_ids.get(word)
+        if wid is None:
+            wid = self.word_ids[word] = len(self.words)
+            self.words.append(word)
+        return wid
+
+    def add_node(self, doc):
+        words = tuple(self.word_id(w) for w in doc['node'])
+        handle = self.node_ids.get(words)
+        if handle is None:
+            handle = self.node_ids[words] = len(self.node_words)
+            self.node_words.append(words)
+            self.outbound_distance.append(doc['outbound_distance'])
+            self.inbound_distance.append(doc['inbound_distance'])
+            self.node_counts.append(doc.get('count') or 0)
+            self.node_seen.append(doc.get('seen') or 0)
+            self.successors.append(array('l'))
+            self.predecessors.append(array('l'))
+            self.link_counts.append(array('l'))
+            self.link_seen.append(array('l'))
+            self.stems.setdefault(
+                doc['base_word_stem'], array('l')).append(handle)
+        else:
+            self.outbound_distance[handle] = min(
+                self.outbound_distance[handle], doc['outbound_distance'])
+            self.inbound_distance[handle] = min(
+                self.inbound_distance[handle], doc['inbound_distance'])
+            self.node_counts[handle] += doc.get('count') or 0
+            self.node_seen[handle] = max(self.node_seen[handle],
+                                         doc.get('seen') or 0)
+        self.dirty = True
+        return handle
+
+    def add_link(self, from_handle, to_handle, count=0, seen=0):
+        successors = self.successors[from_handle]
+        try:
+            i = successors.index(to_handle)
+        except ValueError:
+            successors.append(to_handle)
+            self.predecessors[to_handle].append(from_handle)
+            self.link_counts[from_handle].append(count)
+            self.link_seen[from_handle].append(seen)
+        else:
+            self.link_counts[from_handle][i] += count
+            self.link_seen[from_handle][i] = max(
+                self.link_seen[from_handle][i], seen)
+        self.dirty = True
+
+    def remove_link(self, from_handle, to_handle):
+        i = self.successors[from_handle].index(to_handle)
+        for links in (self.successors, self.link_counts, self.link_seen):
+            del links[from_handle][i]
+        self.predecessors[to_handle].remove(from_handle)
+
+    def add_nodes(self, nodes):
+        return [self.add_node(doc) for doc in nodes]
+
+    def add_edges(self, handles):
+        self.import_edges(count_links(zip(handles, handles[1:])))
+
+    def import_nodes(self, nodes):
+        return {key: self.add_node(doc) for key, doc in nodes.items()}
+
+    def import_edges(self, edges):
+        for from_handle, to_handle, count, seen in edges:
+            self.add_link(from_handle, to_handle, count or 0, seen or 0)
+
+    def set_distances(self, distances):
+        for handle, (outbound, inbound, seen) in distances.items():
+            self.outbound_distance[handle] = outbound
+            self.inbound_distance[handle] = inbound
+        self.dirty = True
+
+    def prune(self, nodes, edges, prefixes):
+        # the nodes left are renumbered in order, which changes their
+        # handles, and the stem and prefix indexes are rebuilt to match
+        for from_handle, to_handle in edges:
+            self.remove_link(from_handle, to_handle)
+        kept = [handle for handle in range(len(self.node_words))
+                if handle not in nodes]
+        renumber = dict(zip(kept, range(len(kept))))
+
+        def renumbered(handles):
+            return array('l', [renumber[h] for h in handles if h in renumber])
+
+        self.node_words = [self.node_words[h] for h in kept]
+        self.node_ids = {words: h for h, words in enumerate(self.node_words)}
+        for name in ('outbound_distance', 'inbound_distance', 'node_counts',
+                     'node_seen'):
+            values = getattr(self, name)
+            setattr(self, name, array('l', [values[h] for h in kept]))
+        for name in ('successors', 'predecessors'):
+            links = getattr(self, name)
+            setattr(self, name, [renumbered(links[h]) for h in kept])
+        self.link_counts = [self.link_counts[h] for h in kept]
+        self.link_seen = [self.link_seen[h] for h in kept]
+        stems = [(stem, renumbered(handles))
+                 for stem, handles in self.stems.items()]
+        self.stems = {stem: handles for stem, handles in stems if handles}
+        entries = [(prefix, count, renumbered(handles))
+                   for prefix, (count, handles) in self.prefixes.items()]
+        self.prefixes = {prefix: [count, handles]
+                         for prefix, count, handles in entries if handles}
+        self.dirty = True
+
+    def nodes_by_stem(self, stem, limit, timeout=None):
+        handles = self.stems.get(stem, ())
+        return random.sample(handles, min(limit, len(handles)))
+
+    def add_counts(self, words, stems):
+        self.word_counts.update(words)
+        self.stem_counts.update(stems)
+        self.dirty = True
+
+    def load_counts(self):
+        return dict(self.word_counts), dict(self.stem_counts)
+
+    def load_pools(self):
+        return dict(self.pools)
+
+    def add_prefixes(self, prefixes):
+        for prefix, (count, handles) in prefixes.items():
+            entry = self.prefixes.get(prefix)
+            if entry is None:
+                entry = self.prefixes[prefix] = [0, array('l')]
+            # a reservoir sample of the nodes the prefix was seen on
+            seen = entry[0]
+            entry[0] += count
+            nodes = entry[1]
+            for handle in handles:
+                seen += 1
+                if handle in nodes:
+                    continue
+                if len(nodes) < MAX_PREFIX_NODES:
+                    nodes.append(handle)
+                elif random.random() * seen < MAX_PREFIX_NODES:
+                    nodes[random.randrange(MAX_PREFIX_NODES)] = handle
+        self.dirty = True
+
+    def nodes_by_prefix(self, prefixes, timeout=None):
+        found = {}
+        for prefix in prefixes:
+            entry = self.prefixes.get(prefix)
+            if entry is not None:
+                found[prefix] = (entry[0], list(entry[1]))
+        return found
+
+    def store_pools(self, pools):
+        self.pools.update(pools)
+        self.dirty = True
+
+    def discard_pools(self, stems):
+        for stem in stems:
+            self.pools.pop(stem, None)
+        self.dirty = True
+
+    def iter_nodes(self):
+        node_stems = {}
+        for stem, handles in self.stems.items():
+            for handle in handles:
+                node_stems[handle] = stem
+        words = self.words
+        for handle, node in enumerate(self.node_words):
+            yield handle, {
+                'node': [words[w] for w in node],
+                'base_word_stem': node_stems[handle],
+                'outbound_distance': self.outbound_distance[handle],
+                'inbound_distance': self.inbound_distance[handle],
+                'count': self.node_counts[handle] or None,
+                'seen': self.node_seen[handle] or None,
+            }
+
+    def iter_edges(self):
+        for from_handle, successors in enumerate(self.successors):
+            for to_handle in successors:
+                yield from_handle, to_handle
+
+    def iter_links(self):
+        for from_handle, successors in enumerate(self.successors):
+            for to_handle, count, seen in zip(successors,
+                                              self.link_counts[from_handle],
+                                              self.link_seen[from_handle]):
+                yield from_handle, to_handle, count or None, seen or None
+
+    def word_chains(self, handle, direction, stop, max_length, timeout=None,
+                    visited=None):
+        links = (self.successors if direction == 'outbound'
+                 else self.predecessors)
+        node_words = self.node_words
+        words = self.words
+        paths = find_chains(handle, links.__getitem__,
+                            lambda node: node_words[node][0],
+                            self.word_ids.get(stop), max_length, timeout,
+                            visited)
+        return [[words[node_words[n][0]] for n in path] for path in paths]
+
+    def sample_chains(self, handle, direction, stop, max_length,
+                      samples=DEF_CHAIN_SAMPLES, timeout=None):
+        if direction == 'outbound':
+            links, distances = self.successors, self.outbound_distance
+        else:
+            links, distances = self.predecessors, self.inbound_distance
+        node_words = self.node_words
+        words = self.words
+        paths = sample_chains(handle, links.__getitem__,
+                              distances.__getitem__,
+                              lambda node: node_words[node][0],
+                              self.word_ids.get(stop), max_length, samples)
+        return [[words[node_words[n][0]] for n in path] for path in paths]
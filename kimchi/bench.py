@@ -0,0 +1,165 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks for the learn and reply hot paths.
+#
+# Corpora are synthetic, with word frequencies following a Zipf
+# distribution so that a few words are shared by many chains, as in real
+# conversation. Against ArangoDB, every HTTP request the brain makes is
+# counted along with the bytes sent and received.
+
+import random
+import time
+from itertools import accumulate, islice
+
+DEF_DBNAME = 'kimchibench'
+DEF_LINES = 2000
+DEF_VOCABULARY = 1000
+DEF_SKEW = 1.1
+DEF_MAX_WORDS = 15
+DEF_REPLIES = 100
+PERCENTILES = (50, 95, 99)
+
+
+def synthetic_corpus(lines=DEF_LINES, vocabulary=DEF_VOCABULARY,
+                     skew=DEF_SKEW, max_words=DEF_MAX_WORDS, seed=0):
+    rng = random.Random(seed)
+    words = ['word{0}'.format(i) for i in range(vocabulary)]
+    weights = list(accumulate(1.0 / (rank + 1) ** skew
+                              for rank in range(vocabulary)))
+    for i in range(lines):
+        yield ' '.join(rng.choices(words, cum_weights=weights,
+                                   k=rng.randint(1, max_words))) + '\n'
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return {'p{0}'.format(p): ordered[min(len(ordered) - 1,
+                                          len(ordered) * p // 100)]
+            for p in PERCENTILES}
+
+
+class RequestCounter(object):
+    def __init__(self, session):
+        self.session = session
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        session.hooks['response'].append(self.count)
+
+    def count(self, response, *args, **kwargs):
+        self.requests += 1
+        self.bytes_sent += len(response.request.body or b'')
+        self.bytes_received += len(response.content)
+
+    def snapshot(self):
+        return {
+            'requests': self.requests,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
+
+    def close(self):
+        self.session.hooks['response'].remove(self.count)
+
+
+def request_counter(brain):
+    conn = getattr(brain.backend, 'conn', None)
+    if conn is not None:
+        return RequestCounter(conn.session)
+
+
+def bench_learn(brain, lines, bulk=False, batch_size=1000):
+    # latencies are per batch in bulk mode and per line otherwise
+    counter = request_counter(brain)
+    latencies = []
+    start = time.perf_counter()
+    if bulk:
+        count = 0
+        for batch in iter(lambda: list(islice(lines, batch_size)), []):
+            batch_start = time.perf_counter()
+            brain.learn_batch(batch)
+            latencies.append(time.perf_counter() - batch_start)
+            count += len(batch)
+    else:
+        for msg in lines:
+            msg_start = time.perf_counter()
+            brain.learn(msg)
+            latencies.append(time.perf_counter() - msg_start)
+        count = len(latencies)
+        # queued learns count towards the time taken
+        brain.flush()
+    elapsed = time.perf_counter() - start
+    report = {
+        'mode': 'bulk' if bulk else 'serial',
+        'lines': count,
+        'seconds': elapsed,
+        'lines_per_second': count / elapsed if elapsed else None,
+        'latency': percentiles(latencies),
+    }
+    if counter is not None:
+        report.update(counter.snapshot())
+        counter.close()
+    return report
+
+
+def bench_reply(brain, messages, deadline=None):
+    counter = request_counter(brain)
+    latencies = []
+    empty = 0
+    start = time.perf_counter()
+    for msg in messages:
+        msg_start = time.perf_counter()
+        words = msg.split()
+        reply = brain.generate_candidate_reply(
+            words, deadline=time.time() + deadline if deadline else None)
+        latencies.append(time.perf_counter() - msg_start)
+        if not reply:
+            empty += 1
+    elapsed = time.perf_counter() - start
+    report = {
+        'replies': len(latencies),
+        'empty': empty,
+        'seconds': elapsed,
+        'replies_per_second': len(latencies) / elapsed if elapsed else None,
+        'latency': percentiles(latencies),
+        'cache': brain.cache_stats(),
+    }
+    if counter is not None:
+        report.update(counter.snapshot())
+        counter.close()
+    return report
+
+
+def run_benchmark(brain, lines=DEF_LINES, vocabulary=DEF_VOCABULARY,
+                  skew=DEF_SKEW, max_words=DEF_MAX_WORDS,
+                  replies=DEF_REPLIES, bulk=False, batch_size=1000,
+                  reply_timeout=None, seed=0):
+    corpus = synthetic_corpus(lines, vocabulary, skew, max_words, seed)
+    messages = list(synthetic_corpus(replies, vocabulary, skew, max_words,
+                                     seed + 1))
+    random.seed(seed)
+    return {
+        'corpus': {
+            'lines': lines,
+            'vocabulary': vocabulary,
+            'skew': skew,
+            'max_words': max_words,
+            'seed': seed,
+        },
+        'learn': bench_learn(brain, corpus, bulk, batch_size),
+        'reply': bench_reply(brain, messages, reply_timeout),
+    }
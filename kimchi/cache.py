@@ -0,0 +1,120 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from collections import OrderedDict
+
+DEF_CACHE_SIZE = 10000
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=DEF_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        # without counting a hit or miss or marking the key as used
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class TaggedLRUCache(LRUCache):
+    # entries can be tagged when they are set and dropped later by tag
+    def __init__(self, maxsize=DEF_CACHE_SIZE):
+        super(TaggedLRUCache, self).__init__(maxsize)
+        self.tagged = {}
+        self.tags = {}
+
+    def set(self, key, value, tags=()):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.untag(key)
+            self.data[key] = value
+            self.data.move_to_end(key)
+            self.tags[key] = tags = frozenset(tags)
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+            while len(self.data) > self.maxsize:
+                self.untag(self.data.popitem(last=False)[0])
+
+    def untag(self, key):
+        for tag in self.tags.pop(key, ()):
+            keys = self.tagged[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tagged[tag]
+
+    def invalidate(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+            self.untag(key)
+
+    def invalidate_tagged(self, tags):
+        with self.lock:
+            keys = set()
+            for tag in tags:
+                keys.update(self.tagged.get(tag, ()))
+            for key in keys:
+                del self.data[key]
+                self.untag(key)
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.tagged.clear()
+            self.tags.clear()
@@ -0,0 +1,191 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Turning messages into chain nodes and links.
+#
+# This is everything about learning that needs no storage, so a Chunker
+# can be sent to worker processes to prepare batches of lines in parallel.
+# Stems and node keys are remembered, up to a limit, as the same words and
+# chunks come up again and again; the remembered values are dropped when
+# the limit is reached and when a Chunker is sent to another process.
+
+import string
+import time
+from collections import Counter
+from hashlib import sha1
+from itertools import chain, islice
+
+import Stemmer
+
+from kimchi.backends import merge_node
+
+PUNCTUATION_MAP = str.maketrans({p: '' for p in string.punctuation})
+DEF_MEMO_SIZE = 100000
+
+
+def remember(memo, items, maxsize):
+    if len(memo) >= maxsize:
+        memo.clear()
+    memo.update(items)
+
+
+class Chunker(object):
+    def __init__(self, chainorder, stop, stemmer_type,
+                 memo_size=DEF_MEMO_SIZE):
+        self.chainorder = chainorder
+        self.stop = stop
+        self.stemmer_type = stemmer_type
+        self.stemmer = Stemmer.Stemmer(stemmer_type)
+        self.memo_size = memo_size
+        self.stems = {}
+        self.keys = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__, stems={}, keys={})
+        del state['stemmer']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.stemmer = Stemmer.Stemmer(self.stemmer_type)
+
+    def stemWord(self, word):
+        stem = self.stems.get(word)
+        if stem is None:
+            stem = self.stemmer.stemWord(
+                word.lower().translate(PUNCTUATION_MAP))
+            remember(self.stems, ((word, stem),), self.memo_size)
+        return stem
+
+    def stem_words(self, words):
+        # the words not seen before are stemmed in one call
+        known = self.stems
+        stems = {}
+        missing = []
+        for word in set(words):
+            stem = known.get(word)
+            if stem is None:
+                missing.append(word)
+            else:
+                stems[word] = stem
+        if missing:
+            new = list(zip(missing, self.stemmer.stemWords(
+                [w.lower().translate(PUNCTUATION_MAP) for w in missing])))
+            stems.update(new)
+            remember(known, new, self.memo_size)
+        return [stems[w] for w in words]
+
+    def node_key(self, node):
+        return self.node_keys([tuple(node)])[0]
+
+    def node_keys(self, nodes):
+        # keys are the sha1 of each node as a list, as they always have been
+        known = self.keys
+        keys = []
+        new = []
+        for node in nodes:
+            key = known.get(node)
+            if key is None:
+                key = sha1(str(list(node)).encode('utf8')).hexdigest()
+                new.append((node, key))
+            keys.append(key)
+        if new:
+            remember(known, new, self.memo_size)
+        return keys
+
+    def chunk_msg(self, msg):
+        # overlapping runs of chainorder + 1 words, then a last, shorter run
+        # of stop words
+        words = [self.stop] + msg.split() + [self.stop] * self.chainorder
+        return chain(zip(*[islice(words, i, None)
+                           for i in range(self.chainorder + 1)]),
+                     [tuple(words[len(words) - self.chainorder:])])
+
+    def make_nodes(self, nodegenerator):
+        nodes = [tuple(node) for node in nodegenerator]
+        keys = self.node_keys(nodes)
+        stems = self.stem_words([node[0] for node in nodes])
+        full_length = len(nodes)
+        seen = int(time.time())
+        return [{
+            '_key': key,
+            'base_word_stem': stem,
+            'node': node,
+            'outbound_distance': full_length - i,  # distance to end
+            'inbound_distance': i + 1,  # distance from start
+            'count': 1,
+            'seen': seen,
+        } for i, (node, key, stem) in enumerate(zip(nodes, keys, stems))]
+
+    def node_prefixes(self, node):
+        # the stemmed runs of two or more words that start the node, up to
+        # the first stop word
+        words = list(node)
+        if self.stop in words:
+            words = words[:words.index(self.stop)]
+        stems = self.stem_words(words)
+        return [' '.join(stems[:k]) for k in range(2, len(stems) + 1)]
+
+    def index_prefixes(self, nodes, handles):
+        # how often each prefix was seen and the nodes it starts
+        prefixes = {}
+        for doc, handle in zip(nodes, handles):
+            for prefix in self.node_prefixes(doc['node']):
+                entry = prefixes.setdefault(prefix, [0, []])
+                entry[0] += 1
+                entry[1].append(handle)
+        return prefixes
+
+    def prepare_batch(self, msgs):
+        # returns the nodes by key, with the smallest distances seen, how
+        # often each link between them was used, by pair of keys, and how
+        # often each word was used
+        nodes = {}
+        edges = Counter()
+        counts = Counter()
+        for msg in msgs:
+            if msg.startswith('#'):
+                continue
+            counts.update(msg.split())
+            keys = []
+            for doc in self.make_nodes(self.chunk_msg(msg)):
+                key = doc['_key']
+                keys.append(key)
+                merge_node(nodes, key, doc)
+            edges.update(zip(keys, keys[1:]))
+        return nodes, edges, counts
+
+
+def merge_batches(batches):
+    nodes = {}
+    edges = Counter()
+    counts = Counter()
+    for batch_nodes, batch_edges, batch_counts in batches:
+        for key, doc in batch_nodes.items():
+            merge_node(nodes, key, doc)
+        edges.update(batch_edges)
+        counts.update(batch_counts)
+    return nodes, edges, counts
+
+
+_worker_chunker = None
+
+
+def init_worker(chunker):
+    global _worker_chunker
+    _worker_chunker = chunker
+
+
+def prepare_lines(lines):
+    return _worker_chunker.prepare_batch(lines)
@@ -0,0 +1,198 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Pruning brains so they stop growing.
+#
+# Learning records how many times each node and link has been learned and
+# when it was last seen. Compacting a brain removes the nodes and links
+# learned fewer than a minimum number of times, and optionally those not
+# seen for too long, unless they were seen within a grace period. Ages are
+# measured from the last thing the brain learned, so a brain that is no
+# longer learning is not pruned away. Nodes then left off every chain from
+# the start of a message to its end are removed too, and the distances of
+# the rest are recomputed over the chains that are left with a breadth
+# first search from the ends of messages and from their starts. Nodes and
+# links learned before their usage was recorded are only removed if they
+# are left off every chain.
+#
+# The whole graph is read in one pass and the changes are written in
+# batches. Nodes and links seen again while a brain in a shared database is
+# being compacted are left as they are.
+
+import contextlib
+import logging
+import threading
+
+from kimchi.stats import metrics
+
+DAY = 24 * 60 * 60
+DEF_MIN_COUNT = 2
+DEF_GRACE = 7 * DAY
+DEF_COMPACT_INTERVAL = DAY
+
+
+def distances_from(sources, links):
+    # the number of nodes on the shortest path from any source, which are 1
+    distances = dict.fromkeys(sources, 1)
+    frontier = list(sources)
+    while frontier:
+        next_frontier = []
+        for node in frontier:
+            distance = distances[node] + 1
+            for next_node in links.get(node, ()):
+                if next_node not in distances:
+                    distances[next_node] = distance
+                    next_frontier.append(next_node)
+        frontier = next_frontier
+    return distances
+
+
+class Compaction(object):
+    def __init__(self, min_count=DEF_MIN_COUNT, grace=DEF_GRACE,
+                 max_age=None):
+        self.min_count = min_count
+        self.grace = grace
+        self.max_age = max_age
+        # the nodes removed by handle, the links removed by pair of handles
+        # with their seen times, and the new distances of the nodes left
+        self.nodes = {}
+        self.links = {}
+        self.distances = {}
+        self.kept = 0
+
+    def expired(self, count, seen, newest):
+        if not seen:
+            return False
+        age = newest - seen
+        if age < self.grace:
+            return False
+        return (count or 0) < self.min_count or (
+            self.max_age is not None and age > self.max_age)
+
+    def plan(self, backend):
+        docs = dict(backend.iter_nodes())
+        links = {(from_handle, to_handle): (count, seen)
+                 for from_handle, to_handle, count, seen
+                 in backend.iter_links()}
+        newest = max([doc.get('seen') or 0 for doc in docs.values()] +
+                     [seen or 0 for count, seen in links.values()],
+                     default=0)
+        removed = {handle for handle, doc in docs.items()
+                   if self.expired(doc.get('count'), doc.get('seen'), newest)}
+        successors = {}
+        predecessors = {}
+        for (from_handle, to_handle), (count, seen) in links.items():
+            if (from_handle in removed or to_handle in removed or
+                    self.expired(count, seen, newest)):
+                self.links[from_handle, to_handle] = seen
+            else:
+                successors.setdefault(from_handle, []).append(to_handle)
+                predecessors.setdefault(to_handle, []).append(from_handle)
+
+        kept = [handle for handle in docs if handle not in removed]
+        outbound = distances_from(
+            [h for h in kept if docs[h]['outbound_distance'] == 1],
+            predecessors)
+        inbound = distances_from(
+            [h for h in kept if docs[h]['inbound_distance'] == 1],
+            successors)
+        for handle in kept:
+            doc = docs[handle]
+            if handle not in outbound or handle not in inbound:
+                # left off every chain, along with its links
+                removed.add(handle)
+                for to_handle in successors.get(handle, ()):
+                    self.links[handle, to_handle] = links[
+                        handle, to_handle][1]
+                for from_handle in predecessors.get(handle, ()):
+                    self.links[from_handle, handle] = links[
+                        from_handle, handle][1]
+            elif (outbound[handle], inbound[handle]) != (
+                    doc['outbound_distance'], doc['inbound_distance']):
+                self.distances[handle] = (outbound[handle], inbound[handle],
+                                          doc.get('seen'))
+        self.nodes = {handle: docs[handle] for handle in removed}
+        self.kept = len(docs) - len(removed)
+        return self
+
+    def stems(self):
+        return {doc['base_word_stem'] for doc in self.nodes.values()}
+
+    def apply(self, backend, chunker):
+        # distances first, as pruning can renumber the nodes left
+        if self.distances:
+            backend.set_distances(self.distances)
+        if self.nodes or self.links:
+            prefixes = chunker.index_prefixes(self.nodes.values(), self.nodes)
+            backend.prune({handle: doc.get('seen')
+                           for handle, doc in self.nodes.items()},
+                          self.links,
+                          {prefix: handles for prefix, (count, handles)
+                           in prefixes.items()})
+        metrics.inc('kimchi_compacted_total', len(self.nodes), kind='node')
+        metrics.inc('kimchi_compacted_total', len(self.links), kind='link')
+
+    def stats(self):
+        return {
+            'nodes': len(self.nodes),
+            'links': len(self.links),
+            'distances': len(self.distances),
+            'kept': self.kept,
+        }
+
+
+class Compactor(object):
+    # compacts a brain every interval seconds on a background thread
+    def __init__(self, brain, interval=DEF_COMPACT_INTERVAL, lock=None,
+                 **kwargs):
+        self.brain = brain
+        self.interval = interval
+        self.kwargs = kwargs
+        self.lock = contextlib.nullcontext() if lock is None else lock
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.runs = 0
+        self.errors = 0
+        self.last = None
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.closed.wait(self.interval):
+            try:
+                with self.lock:
+                    compaction = self.brain.compact(**self.kwargs)
+            except Exception:
+                self.errors += 1
+                logging.exception("Failed to compact the brain")
+                continue
+            self.runs += 1
+            self.last = compaction.stats()
+            logging.info("Compacted the brain, removing %d nodes and %d "
+                         "links", len(compaction.nodes),
+                         len(compaction.links))
+
+    def close(self):
+        self.closed.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'errors': self.errors,
+            'last': self.last,
+        }
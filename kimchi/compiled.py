@@ -0,0 +1,306 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compiled, read-only brain files.
+#
+# A compiled brain is a single file that is memory-mapped by the reader, so
+# that opening it costs the same whatever the size of the brain and the
+# pages are shared between processes. It holds, in native byte order:
+#
+#  * a fixed header (including the stop word's id) followed by the offset
+#    of each section
+#  * the brain's control info and reply pools as JSON
+#  * the word and stem counts as JSON, only parsed when they are needed
+#  * an interned word table (offsets into a UTF-8 blob), which also holds
+#    the stems
+#  * fixed-width node records: chainorder + 1 word ids (padded with -1),
+#    inbound_distance, outbound_distance and stem id
+#  * CSR-style successor and predecessor arrays
+#  * a stem index: stem ids sorted by stem, each with a range of node ids
+
+import io
+import json
+import mmap
+import os
+import random
+import struct
+from array import array
+
+from kimchi.backends import DEF_DATADIR, find_chains
+from kimchi.walker import DEF_CHAIN_SAMPLES, sample_chains
+
+MAGIC = b'KMC1'
+HEADER = struct.Struct('=4sIIqqqqq')
+SECTIONS = ('info', 'counts', 'word_offsets', 'word_blob', 'nodes',
+            'successor_offsets', 'successors', 'predecessor_offsets',
+            'predecessors', 'stems', 'stem_offsets', 'stem_nodes')
+SECTION_TABLE = struct.Struct('={0}q'.format(len(SECTIONS)))
+ALIGNMENT = 8
+
+# extra fields in each node record after the word ids
+INBOUND, OUTBOUND, STEM = range(3)
+NODE_FIELDS = 3
+
+
+def compiled_path(dbname, datadir=DEF_DATADIR):
+    return os.path.join(datadir, dbname + '.kmc')
+
+
+def load_json(section):
+    return json.loads(bytes(section).rstrip(b'\0').decode('utf8'))
+
+
+def csr(links, count):
+    offsets = array('q', [0])
+    targets = array('i')
+    for node in range(count):
+        targets.extend(links.get(node, ()))
+        offsets.append(len(targets))
+    return offsets, targets
+
+
+def compile_brain(backend, info, path):
+    words = []
+    word_ids = {}
+
+    def word_id(word):
+        wid = word_ids.get(word)
+        if wid is None:
+            wid = word_ids[word] = len(words)
+            words.append(word)
+        return wid
+
+    width = info['chainorder'] + 1
+    node_ids = {}
+    nodes = array('i')
+    stems = {}
+    for handle, doc in backend.iter_nodes():
+        node_id = node_ids[handle] = len(node_ids)
+        node = [word_id(w) for w in doc['node']]
+        stem = word_id(doc['base_word_stem'])
+        nodes.extend(node + [-1] * (width - len(node)))
+        nodes.extend([doc['inbound_distance'], doc['outbound_distance'],
+                      stem])
+        stems.setdefault(stem, []).append(node_id)
+
+    successors = {}
+    predecessors = {}
+    edge_count = 0
+    for from_handle, to_handle in backend.iter_edges():
+        from_id, to_id = node_ids[from_handle], node_ids[to_handle]
+        successors.setdefault(from_id, []).append(to_id)
+        predecessors.setdefault(to_id, []).append(from_id)
+        edge_count += 1
+
+    encoded = [w.encode('utf8') for w in words]
+    word_offsets = array('q', [0])
+    for word in encoded:
+        word_offsets.append(word_offsets[-1] + len(word))
+
+    sorted_stems = array('i', sorted(stems, key=encoded.__getitem__))
+    stem_offsets = array('q', [0])
+    stem_nodes = array('i')
+    for stem in sorted_stems:
+        stem_nodes.extend(stems[stem])
+        stem_offsets.append(len(stem_nodes))
+
+    # reply pools go in with the control info, but the counts, which grow
+    # with the brain, have their own section
+    info = dict(info)
+    info['reply_pools'] = backend.load_pools()
+    sections = [json.dumps(info).encode('utf8'),
+                json.dumps(backend.load_counts()).encode('utf8'),
+                word_offsets, b''.join(encoded), nodes]
+    sections.extend(csr(successors, len(node_ids)))
+    sections.extend(csr(predecessors, len(node_ids)))
+    sections.extend([sorted_stems, stem_offsets, stem_nodes])
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 1, width, len(words), len(node_ids),
+                            edge_count, len(sorted_stems),
+                            word_ids.get(info['stop'], -1)))
+        table_pos = f.tell()
+        f.write(SECTION_TABLE.pack(*[0] * len(SECTIONS)))
+        offsets = []
+        for section in sections:
+            f.write(b'\0' * (-f.tell() % ALIGNMENT))
+            offsets.append(f.tell())
+            f.write(section if isinstance(section, bytes)
+                    else section.tobytes())
+        offsets.append(f.tell())
+        f.seek(table_pos)
+        f.write(SECTION_TABLE.pack(*offsets[:-1]))
+    os.replace(tmp_path, path)
+    return len(node_ids), edge_count
+
+
+class CompiledBackend(object):
+    def __init__(self, dbname="chains", datadir=DEF_DATADIR, path=None):
+        if path is None:
+            path = compiled_path(dbname, datadir)
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self.mmap)
+        (magic, version, self.width, word_count, node_count, edge_count,
+         stem_count, self.stop_id) = HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError("{0} is not a compiled brain".format(path))
+        starts = SECTION_TABLE.unpack_from(buf, HEADER.size)
+        sizes = {
+            'word_offsets': (word_count + 1) * 8,
+            'nodes': node_count * (self.width + NODE_FIELDS) * 4,
+            'successor_offsets': (node_count + 1) * 8,
+            'successors': edge_count * 4,
+            'predecessor_offsets': (node_count + 1) * 8,
+            'predecessors': edge_count * 4,
+            'stems': stem_count * 4,
+            'stem_offsets': (stem_count + 1) * 8,
+            'stem_nodes': node_count * 4,
+        }
+        section = {}
+        for i, name in enumerate(SECTIONS):
+            end = (starts[i] + sizes[name] if name in sizes
+                   else starts[i + 1])
+            section[name] = buf[starts[i]:end]
+        end_of_blob = section['word_offsets'].cast('q')[-1]
+        self.info = load_json(section['info'])
+        self.counts = section['counts']
+        self.word_offsets = section['word_offsets'].cast('q')
+        self.word_blob = section['word_blob'][:end_of_blob]
+        self.nodes = section['nodes'].cast('i')
+        self.successor_offsets = section['successor_offsets'].cast('q')
+        self.successors = section['successors'].cast('i')
+        self.predecessor_offsets = section['predecessor_offsets'].cast('q')
+        self.predecessors = section['predecessors'].cast('i')
+        self.stems = section['stems'].cast('i')
+        self.stem_offsets = section['stem_offsets'].cast('q')
+        self.stem_nodes = section['stem_nodes'].cast('i')
+        self.record_size = self.width + NODE_FIELDS
+
+    def close(self):
+        pass
+
+    def word_bytes(self, word_id):
+        offsets = self.word_offsets
+        return self.word_blob[offsets[word_id]:offsets[word_id + 1]]
+
+    def word(self, word_id):
+        return bytes(self.word_bytes(word_id)).decode('utf8')
+
+    def first_word(self, node):
+        return self.nodes[node * self.record_size]
+
+    def node_field(self, node, field):
+        return self.nodes[node * self.record_size + self.width + field]
+
+    def links(self, offsets, targets, node):
+        return targets[offsets[node]:offsets[node + 1]]
+
+    def get_or_set_info(self, key, value):
+        return self.info.get(key, value)
+
+    def load_info(self):
+        return {key: value for key, value in self.info.items()
+                if key != 'reply_pools'}
+
+    def get_info(self, key, default=None):
+        return self.info.get(key, default)
+
+    def read_only(self, *args, **kwargs):
+        raise io.UnsupportedOperation("compiled brains are read-only")
+
+    add_nodes = add_edges = import_nodes = import_edges = read_only
+    add_counts = store_pools = set_info = add_prefixes = read_only
+    set_distances = prune = discard_pools = drop = read_only
+
+    def load_counts(self):
+        words, stems = load_json(self.counts)
+        return words, stems
+
+    def load_pools(self):
+        return self.info.get('reply_pools', {})
+
+    def nodes_by_prefix(self, prefixes, timeout=None):
+        # compiled brains have no prefix index, so seeding falls back to
+        # single words
+        return {}
+
+    def iter_nodes(self):
+        for node in range(len(self.nodes) // self.record_size):
+            start = node * self.record_size
+            words = self.nodes[start:start + self.width]
+            yield node, {
+                'node': [self.word(w) for w in words if w != -1],
+                'base_word_stem': self.word(self.node_field(node, STEM)),
+                'outbound_distance': self.node_field(node, OUTBOUND),
+                'inbound_distance': self.node_field(node, INBOUND),
+            }
+
+    def iter_edges(self):
+        for node in range(len(self.successor_offsets) - 1):
+            for next_node in self.links(self.successor_offsets,
+                                        self.successors, node):
+                yield node, next_node
+
+    def iter_links(self):
+        # compiled brains keep no usage
+        for node, next_node in self.iter_edges():
+            yield node, next_node, None, None
+
+    def stem_range(self, stem):
+        target = stem.encode('utf8')
+        stems = self.stems
+        low, high = 0, len(stems)
+        while low < high:
+            mid = (low + high) // 2
+            if bytes(self.word_bytes(stems[mid])) < target:
+                low = mid + 1
+            else:
+                high = mid
+        if low == len(stems) or self.word_bytes(stems[low]) != target:
+            return range(0)
+        return range(self.stem_offsets[low], self.stem_offsets[low + 1])
+
+    def nodes_by_stem(self, stem, limit, timeout=None):
+        positions = self.stem_range(stem)
+        return [self.stem_nodes[i] for i in
+                random.sample(positions, min(limit, len(positions)))]
+
+    def word_chains(self, handle, direction, stop, max_length, timeout=None,
+                    visited=None):
+        if direction == 'outbound':
+            offsets, targets = self.successor_offsets, self.successors
+        else:
+            offsets, targets = self.predecessor_offsets, self.predecessors
+        paths = find_chains(
+            handle, lambda node: self.links(offsets, targets, node),
+            self.first_word, self.stop_id, max_length, timeout, visited)
+        return [[self.word(self.first_word(n)) for n in path]
+                for path in paths]
+
+    def sample_chains(self, handle, direction, stop, max_length,
+                      samples=DEF_CHAIN_SAMPLES, timeout=None):
+        if direction == 'outbound':
+            offsets, targets = self.successor_offsets, self.successors
+            field = OUTBOUND
+        else:
+            offsets, targets = self.predecessor_offsets, self.predecessors
+            field = INBOUND
+        paths = sample_chains(
+            handle, lambda node: self.links(offsets, targets, node),
+            lambda node: self.node_field(node, field), self.first_word,
+            self.stop_id, max_length, samples)
+        return [[self.word(self.first_word(n)) for n in path]
+                for path in paths]
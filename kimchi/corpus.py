@@ -0,0 +1,120 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reading corpus files to learn from, with checkpoints.
+#
+# Files are read as bytes in large blocks and handed out in batches of
+# lines. Once a batch has been learned the reader records a checkpoint in
+# the brain's control info: the file, how far into it learning has got and
+# a hash of the bytes either side of the start and of that point. Learning
+# the same file again starts from the checkpoint, provided the file still
+# matches it, so a restarted import carries on where it stopped and an
+# appended log only has its new lines learned. A last line without a
+# newline may still be being written, so it is neither learned nor
+# checkpointed until it is finished, unless the file is known to be
+# complete. Input that cannot be seeked, such as a pipe, is read without
+# checkpoints and is complete once it ends.
+
+import logging
+import os
+import time
+from hashlib import sha1
+from itertools import islice
+
+from kimchi.backends import count_key
+
+DEF_READ_SIZE = 1 << 20
+CHECK_SIZE = 1 << 16
+
+
+class CorpusReader(object):
+    def __init__(self, infile, backend, resume=True,
+                 read_size=DEF_READ_SIZE, complete=False):
+        self.infile = infile
+        self.backend = backend
+        self.read_size = read_size
+        self.complete = complete
+        self.offset = 0
+        self.lines = 0
+        # how far the batches handed out so far go
+        self.read_offset = 0
+        self.read_lines = 0
+        self.key = None
+        name = getattr(infile, 'name', None)
+        if (infile.seekable() and isinstance(name, str) and
+                os.path.isfile(name)):
+            self.path = os.path.realpath(infile.name)
+            self.key = count_key('checkpoint', self.path)
+            if resume:
+                self.resume()
+
+    def digest(self, offset):
+        # a hash of the bytes at the start of the file and before offset
+        position = self.infile.tell()
+        digest = sha1()
+        for start in (0, max(0, offset - CHECK_SIZE)):
+            self.infile.seek(start)
+            digest.update(self.infile.read(min(offset - start, CHECK_SIZE)))
+        self.infile.seek(position)
+        return digest.hexdigest()
+
+    def resume(self):
+        checkpoint = self.backend.get_info(self.key)
+        if not checkpoint:
+            return
+        offset = checkpoint['offset']
+        if (offset > os.fstat(self.infile.fileno()).st_size or
+                self.digest(offset) != checkpoint['digest']):
+            logging.warning("%s has changed since it was last learned, "
+                            "learning all of it", self.path)
+            return
+        self.infile.seek(offset)
+        self.offset = self.read_offset = offset
+        self.lines = self.read_lines = checkpoint['lines']
+        logging.info("Resuming %s from line %d", self.path, self.lines)
+
+    def iter_lines(self):
+        while True:
+            lines = self.infile.readlines(self.read_size)
+            if not lines:
+                return
+            for line in lines:
+                if (not line.endswith(b'\n') and self.key is not None and
+                        not self.complete):
+                    logging.info("Leaving the unfinished last line of %s "
+                                 "until it is finished", self.path)
+                    return
+                self.read_offset += len(line)
+                self.read_lines += 1
+                yield line.decode('utf8', 'replace')
+
+    def batches(self, batch_size):
+        lines = self.iter_lines()
+        return iter(lambda: list(islice(lines, batch_size)), [])
+
+    def commit(self):
+        # checkpoints everything in the batches handed out so far
+        self.offset, self.lines = self.read_offset, self.read_lines
+        if self.key is None:
+            return
+        stat = os.fstat(self.infile.fileno())
+        self.backend.set_info(self.key, {
+            'path': self.path,
+            'device': stat.st_dev,
+            'inode': stat.st_ino,
+            'offset': self.offset,
+            'lines': self.lines,
+            'digest': self.digest(self.offset),
+            'time': time.time(),
+        })
@@ -0,0 +1,464 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# An in-process stand-in for the parts of the ArangoDB HTTP API used by
+# kimchi, for benchmarking without a database server.
+#
+# Documents live in dicts and every request is served under one lock per
+# database. Traversals return the paths the kimchi visitor would collect,
+# without running its JavaScript. The filter is not applied: it compares
+# path.length, which is undefined for traversal paths, so it never
+# excludes anything on a real server either. Only the AQL queries kimchi
+# sends are understood.
+
+import itertools
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from kimchi.backends import (ADD_COUNTS, ADD_PREFIXES, DISTANCES,
+                             REMOVE_KEYS, REMOVE_PREFIX_NODES, REMOVE_UNSEEN,
+                             SAMPLE_BY_STEM, SET_DISTANCES, UPSERT_LINKS,
+                             UPSERT_NODES, unique)
+
+DOCUMENT_COLLECTION = 2
+EDGE_COLLECTION = 3
+DEF_BATCH_SIZE = 1000
+MAX_ITERATIONS = 1000000
+
+
+def error(code, num, message):
+    return code, {'error': True, 'code': code, 'errorNum': num,
+                  'errorMessage': message}
+
+
+def replace_slots(nodes, slots, limit, chance):
+    replaced = []
+    for i in range(limit):
+        node = nodes[i] if i < len(nodes) else None
+        new = slots[i] if slots[i] not in nodes else None
+        if node is None and new is None:
+            continue
+        replaced.append(new if new is not None and (
+            node is None or random.random() < chance) else node)
+    return replaced
+
+
+def is_true(value):
+    return str(value).lower() in ('true', '1')
+
+
+def add_usage(doc, update):
+    # as AQL adds null counts as 0 and MAX ignores nulls
+    doc['count'] = (doc.get('count') or 0) + (update.get('count') or 0)
+    seen = [s for s in (doc.get('seen'), update.get('seen')) if s is not None]
+    doc['seen'] = max(seen) if seen else None
+
+
+class FakeDatabase(object):
+    def __init__(self):
+        self.collections = {}
+        self.types = {}
+        self.cursors = {}
+        # edge keys by collection and vertex, for neighbour lookups
+        self.outbound = {}
+        self.inbound = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.RLock()
+
+    def collection(self, name, create=False, kind=DOCUMENT_COLLECTION):
+        if name not in self.collections:
+            if not create:
+                return None
+            self.collections[name] = {}
+            self.types[name] = kind
+            self.outbound[name] = {}
+            self.inbound[name] = {}
+        return self.collections[name]
+
+    def store(self, name, doc):
+        collection = self.collections[name]
+        self.remove(name, doc['_key'])
+        collection[doc['_key']] = doc
+        if self.types[name] == EDGE_COLLECTION:
+            key = doc['_key']
+            self.outbound[name].setdefault(doc['_from'], set()).add(key)
+            self.inbound[name].setdefault(doc['_to'], set()).add(key)
+
+    def remove(self, name, key):
+        doc = self.collections[name].pop(key, None)
+        if doc is not None and self.types[name] == EDGE_COLLECTION:
+            self.outbound[name][doc['_from']].discard(key)
+            self.inbound[name][doc['_to']].discard(key)
+
+    def cursor_result(self, results, batch_size=None):
+        batch_size = batch_size or DEF_BATCH_SIZE
+        resp = {'error': False, 'code': 201,
+                'result': results[:batch_size],
+                'hasMore': len(results) > batch_size}
+        if resp['hasMore']:
+            cursor_id = str(next(self.ids))
+            self.cursors[cursor_id] = (results[batch_size:], batch_size)
+            resp['id'] = cursor_id
+        return 201, resp
+
+
+class FakeArango(object):
+    def __init__(self):
+        self.databases = {'_system': FakeDatabase()}
+
+    def handle(self, method, path, query, body):
+        parts = [unquote(p) for p in path.strip('/').split('/')]
+        dbname = '_system'
+        if parts[:1] == ['_db']:
+            dbname, parts = parts[1], parts[2:]
+        if parts[:1] != ['_api'] or len(parts) < 2:
+            return error(404, 404, 'unknown path')
+        if parts[1] == 'database':
+            return self.api_database(method, parts[2:], body)
+        db = self.databases.get(dbname)
+        if db is None:
+            return error(404, 1228, 'database not found')
+        handler = getattr(self, 'api_' + parts[1].replace('-', '_'), None)
+        if handler is None:
+            return error(404, 404, 'unknown path')
+        with db.lock:
+            return handler(db, method, parts[2:], query, body)
+
+    def api_database(self, method, path, body):
+        if method == 'DELETE':
+            if self.databases.pop(path[0], None) is None:
+                return error(404, 1228, 'database not found')
+            return 200, {'error': False, 'code': 200, 'result': True}
+        if body['name'] in self.databases:
+            return error(409, 1207, 'duplicate name')
+        self.databases[body['name']] = FakeDatabase()
+        return 201, {'error': False, 'code': 201, 'result': True}
+
+    def api_collection(self, db, method, path, query, body):
+        if body['name'] in db.collections:
+            return error(409, 1207, 'duplicate name')
+        db.collection(body['name'], True,
+                      body.get('type', DOCUMENT_COLLECTION))
+        return 200, {'error': False, 'code': 200, 'name': body['name'],
+                     'type': db.types[body['name']]}
+
+    def api_index(self, db, method, path, query, body):
+        if db.collection(query['collection']) is None:
+            return error(404, 1203, 'collection not found')
+        return 201, {'error': False, 'code': 201, 'isNewlyCreated': True,
+                     'type': body['type'], 'fields': body['fields']}
+
+    def api_document(self, db, method, path, query, body,
+                     kind=DOCUMENT_COLLECTION):
+        if method == 'POST':
+            name = query['collection']
+            collection = db.collection(
+                name, is_true(query.get('createCollection')), kind)
+            if collection is None:
+                return error(404, 1203, 'collection not found')
+            doc = dict(body)
+            key = doc.get('_key') or str(next(db.ids))
+            if key in collection:
+                return error(409, 1210, 'unique constraint violated')
+            doc.update({'_key': key, '_id': name + '/' + key,
+                        '_rev': str(next(db.ids))})
+            if kind == EDGE_COLLECTION:
+                doc.setdefault('_from', query.get('from'))
+                doc.setdefault('_to', query.get('to'))
+            db.store(name, doc)
+            return 202, {'error': False, '_id': doc['_id'], '_key': key,
+                         '_rev': doc['_rev']}
+        name, key = path[0], path[1]
+        collection = db.collection(name)
+        if collection is None or key not in collection:
+            return error(404, 1202, 'document not found')
+        if method == 'GET':
+            return 200, dict(collection[key], error=False)
+        if method in ('PUT', 'PATCH'):
+            doc = dict(collection[key]) if method == 'PATCH' else {}
+            doc.update(body)
+            doc.update({'_key': key, '_id': name + '/' + key,
+                        '_rev': str(next(db.ids))})
+            db.store(name, doc)
+            return 202, {'error': False, '_id': doc['_id'], '_key': key,
+                         '_rev': doc['_rev']}
+        if method == 'DELETE':
+            db.remove(name, key)
+            return 202, {'error': False, '_id': name + '/' + key}
+        return error(405, 405, 'method not supported')
+
+    def api_edge(self, db, method, path, query, body):
+        return self.api_document(db, method, path, query, body,
+                                 kind=EDGE_COLLECTION)
+
+    def api_edges(self, db, method, path, query, body):
+        collection = db.collection(path[0])
+        if collection is None:
+            return error(404, 1203, 'collection not found')
+        vertex = query['vertex']
+        direction = query.get('direction', 'any')
+        keys = set()
+        if direction != 'in':
+            keys.update(db.outbound[path[0]].get(vertex, ()))
+        if direction != 'out':
+            keys.update(db.inbound[path[0]].get(vertex, ()))
+        edges = [collection[k] for k in keys]
+        return 200, {'error': False, 'code': 200, 'edges': edges}
+
+    def api_import(self, db, method, path, query, body):
+        name = query['collection']
+        kind = (EDGE_COLLECTION
+                if query.get('createCollectionType') == 'edge'
+                else DOCUMENT_COLLECTION)
+        collection = db.collection(
+            name, is_true(query.get('createCollection')), kind)
+        if collection is None:
+            return error(404, 1203, 'collection not found')
+        on_duplicate = query.get('onDuplicate', 'error')
+        stats = {'error': False, 'created': 0, 'errors': 0, 'empty': 0,
+                 'updated': 0, 'ignored': 0}
+        for doc in body:
+            key = doc.get('_key') or str(next(db.ids))
+            doc = dict(doc, _key=key, _id=name + '/' + key)
+            if key not in collection:
+                db.store(name, doc)
+                stats['created'] += 1
+            elif on_duplicate == 'update':
+                db.store(name, dict(collection[key], **doc))
+                stats['updated'] += 1
+            elif on_duplicate == 'replace':
+                db.store(name, doc)
+                stats['updated'] += 1
+            elif on_duplicate == 'ignore':
+                stats['ignored'] += 1
+            else:
+                stats['errors'] += 1
+        return 201, stats
+
+    def api_simple(self, db, method, path, query, body):
+        collection = db.collection(body['collection'])
+        if collection is None:
+            return error(404, 1203, 'collection not found')
+        if path[0] == 'by-example':
+            example = body['example']
+            results = [doc for doc in collection.values()
+                       if all(doc.get(k) == v for k, v in example.items())]
+            if body.get('limit') is not None:
+                results = results[:body['limit']]
+            return db.cursor_result(results, body.get('batchSize'))
+        if path[0] == 'all':
+            return db.cursor_result(list(collection.values()),
+                                    body.get('batchSize'))
+        if path[0] == 'lookup-by-keys':
+            return 200, {'error': False, 'code': 200, 'documents': [
+                collection[k] for k in body['keys'] if k in collection]}
+        return error(404, 404, 'unknown simple query')
+
+    def api_cursor(self, db, method, path, query, body):
+        if method == 'PUT' and path:
+            if path[0] not in db.cursors:
+                return error(404, 1600, 'cursor not found')
+            results, batch_size = db.cursors.pop(path[0])
+            return db.cursor_result(results, batch_size)
+        if method == 'DELETE' and path:
+            if db.cursors.pop(path[0], None) is None:
+                return error(404, 1600, 'cursor not found')
+            return 202, {'error': False, 'code': 202, 'id': path[0]}
+        bind_vars = body.get('bindVars', {})
+        if body['query'] == ADD_COUNTS:
+            name = bind_vars['@collection']
+            collection = db.collection(name)
+            if collection is None:
+                return error(404, 1203, 'collection not found')
+            for count in bind_vars['counts']:
+                doc = dict(collection.get(count['_key']) or count,
+                           _id=name + '/' + count['_key'])
+                if count['_key'] in collection:
+                    doc['count'] += count['count']
+                db.store(name, doc)
+            return db.cursor_result([])
+        if body['query'] == ADD_PREFIXES:
+            name = bind_vars['@collection']
+            collection = db.collection(name)
+            if collection is None:
+                return error(404, 1203, 'collection not found')
+            limit = bind_vars['limit']
+            for prefix in bind_vars['prefixes']:
+                old = collection.get(prefix['_key'])
+                doc = {'_key': prefix['_key'], 'prefix': prefix['prefix'],
+                       'count': prefix['count'], 'nodes': prefix['nodes'],
+                       '_id': name + '/' + prefix['_key']}
+                if old is not None:
+                    doc['count'] += old['count']
+                    doc['nodes'] = unique(old['nodes'] + prefix['nodes'])
+                    if len(doc['nodes']) > limit:
+                        doc['nodes'] = replace_slots(
+                            old['nodes'], prefix['slots'], limit,
+                            limit * prefix['weight'] / doc['count'])
+                db.store(name, doc)
+            return db.cursor_result([])
+        if body['query'] in (UPSERT_NODES, UPSERT_LINKS):
+            name = bind_vars['@collection']
+            collection = db.collection(name)
+            if collection is None:
+                return error(404, 1203, 'collection not found')
+            for node in bind_vars.get('nodes') or bind_vars['links']:
+                doc = dict(collection.get(node['_key']) or node,
+                           _id=name + '/' + node['_key'])
+                if node['_key'] in collection:
+                    add_usage(doc, node)
+                    if body['query'] == UPSERT_NODES:
+                        for dist in DISTANCES:
+                            doc[dist] = min(doc[dist], node[dist])
+                db.store(name, doc)
+            return db.cursor_result([])
+        if body['query'] in (REMOVE_UNSEEN, SET_DISTANCES):
+            name = bind_vars['@collection']
+            collection = db.collection(name)
+            if collection is None:
+                return error(404, 1203, 'collection not found')
+            for update in bind_vars['docs']:
+                doc = collection.get(update['_key'])
+                if doc is None or doc.get('seen') != update['seen']:
+                    continue
+                if body['query'] == REMOVE_UNSEEN:
+                    db.remove(name, update['_key'])
+                else:
+                    db.store(name, dict(doc, **{
+                        dist: update[dist] for dist in DISTANCES}))
+            return db.cursor_result([])
+        if body['query'] == REMOVE_KEYS:
+            name = bind_vars['@collection']
+            if db.collection(name) is None:
+                return error(404, 1203, 'collection not found')
+            for key in bind_vars['keys']:
+                db.remove(name, key)
+            return db.cursor_result([])
+        if body['query'] == REMOVE_PREFIX_NODES:
+            name = bind_vars['@collection']
+            collection = db.collection(name)
+            if collection is None:
+                return error(404, 1203, 'collection not found')
+            for prefix in bind_vars['prefixes']:
+                doc = collection.get(prefix['_key'])
+                if doc is not None:
+                    db.store(name, dict(doc, nodes=[
+                        n for n in doc['nodes'] if n not in prefix['nodes']]))
+            return db.cursor_result([])
+        if body['query'] == SAMPLE_BY_STEM:
+            collection = db.collection(bind_vars['@collection'])
+            if collection is None:
+                return error(404, 1203, 'collection not found')
+            # in key order from the start key, as through a persistent index
+            matches = sorted((doc['_key'], doc['_id'])
+                             for doc in collection.values()
+                             if doc.get('base_word_stem') == bind_vars['stem'])
+            start = bind_vars['start']
+            ordered = ([i for k, i in matches if k >= start] +
+                       [i for k, i in matches if k < start])
+            return db.cursor_result(ordered[:bind_vars['limit']],
+                                    body.get('batchSize'))
+        return error(400, 1501, 'unsupported query')
+
+    def api_traversal(self, db, method, path, query, body):
+        name = body['edgeCollection']
+        edges = db.collection(name)
+        start = body['startVertex']
+        vertices = db.collection(start.split('/', 1)[0]) or {}
+        if edges is None or start.split('/', 1)[1] not in vertices:
+            return error(404, 1202, 'document not found')
+        if body.get('direction') == 'inbound':
+            index, end = db.inbound[name], '_from'
+        else:
+            index, end = db.outbound[name], '_to'
+
+        def links(vertex):
+            return sorted(edges[k][end] for k in index.get(vertex, ()))
+        max_depth = body.get('maxDepth')
+        max_iterations = body.get('maxIterations', MAX_ITERATIONS)
+
+        def first_word(handle):
+            return vertices[handle.split('/', 1)[1]]['node'][0]
+
+        paths = []
+        vertex_paths = []
+        stack = [(start,)]
+        while stack:
+            if len(paths) >= max_iterations:
+                return error(500, 1909, 'too many iterations')
+            vertex_path = stack.pop()
+            vertex_paths.append(vertex_path)
+            paths.append([first_word(v) for v in vertex_path])
+            if max_depth is not None and len(vertex_path) > max_depth:
+                continue
+            for next_vertex in reversed(links(vertex_path[-1])):
+                if next_vertex not in vertex_path:
+                    stack.append(vertex_path + (next_vertex,))
+        return 200, {'error': False, 'code': 200, 'result': {
+            'visited': {'vertices': [p[-1] for p in vertex_paths],
+                        'paths': paths}}}
+
+
+class FakeArangoHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if len(raw) < length:
+            self.close_connection = True
+            return
+        body = json.loads(raw.decode('utf8')) if raw else None
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        code, resp = self.server.arango.handle(
+            self.command, url.path, query, body)
+        data = json.dumps(resp).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+
+class FakeArangoServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super(FakeArangoServer, self).__init__(address, FakeArangoHandler)
+        self.arango = FakeArango()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -12,36 +12,97 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from functools import partial
 import json
-from urllib.parse import urljoin
+import logging
+import time
+from urllib.parse import urljoin, urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout
+from requests.packages.urllib3.util.retry import Retry
 
-def _get(url, **kwargs):
-    r = requests.get(url, **kwargs)
-    return json.loads(r.text)
+from kimchi.stats import metrics
 
-def _post(url, payload, **kwargs):
-    r = requests.post(url, data=json.dumps(payload), **kwargs)
-    return json.loads(r.text)
+DEF_POOL_SIZE = 10
+DEF_RETRIES = 3
+MAX_CHILDREN = 1024
 
-def _put(url, payload, **kwargs):
-    r = requests.put(url, data=json.dumps(payload), **kwargs)
-    return json.loads(r.text)
 
-def _delete(url, **kwargs):
-    r = requests.delete(url.rstrip('/'), **kwargs)
+def make_session(pool_size=DEF_POOL_SIZE, retries=DEF_RETRIES,
+                 trust_env=False):
+    session = requests.Session()
+    # looking up proxy settings in the environment costs more than a
+    # keep-alive round-trip to a local database
+    session.trust_env = trust_env
+    # read errors are not retried so that a request timeout is a hard limit
+    retry = Retry(total=retries, read=False, backoff_factor=0.1)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def _encode(payload):
+    # bytes bodies go out in the same packet as the headers
+    return json.dumps(payload).encode('utf8')
+
+def endpoint(url):
+    # the API path without document handles or cursor ids, for grouping
+    parts = urlsplit(url).path.strip('/').split('/')
+    if '_api' not in parts:
+        return '/'.join(parts)
+    parts = parts[parts.index('_api'):]
+    return '/'.join(parts[:3] if parts[1:2] == ['simple'] else parts[:2])
+
+def _request(session, method, url, data=None, **kwargs):
+    if not metrics.enabled:
+        return json.loads(session.request(method, url, data=data,
+                                          **kwargs).text)
+    labels = {'method': method, 'endpoint': endpoint(url)}
+    start = time.perf_counter()
+    r = session.request(method, url, data=data, **kwargs)
+    metrics.observe('kimchi_http_request_seconds',
+                    time.perf_counter() - start, **labels)
+    metrics.inc('kimchi_http_requests_total', status=r.status_code,
+                **labels)
+    metrics.inc('kimchi_http_sent_bytes_total', len(data or b''), **labels)
+    metrics.inc('kimchi_http_received_bytes_total', len(r.content), **labels)
     return json.loads(r.text)
 
+def _get(session, url, **kwargs):
+    return _request(session, 'GET', url, **kwargs)
+
+def _post(session, url, payload, **kwargs):
+    return _request(session, 'POST', url, _encode(payload), **kwargs)
+
+def _put(session, url, payload, **kwargs):
+    return _request(session, 'PUT', url, _encode(payload), **kwargs)
+
+def _delete(session, url, **kwargs):
+    return _request(session, 'DELETE', url.rstrip('/'), **kwargs)
+
 
 class GenericAPI(object):
-    def __init__(self, the_url):
-        self.the_url = the_url if the_url[-1] is '/' else the_url + '/'
+    def __init__(self, the_url, session=None, pool_size=DEF_POOL_SIZE,
+                 retries=DEF_RETRIES):
+        self.the_url = the_url if the_url[-1] == '/' else the_url + '/'
+        if session is None:
+            session = make_session(pool_size, retries)
+        self.session = session
+        self._children = {}
 
     def __getattr__(self, key):
-        new_base = urljoin(self.the_url, key)
-        return self.__class__(the_url=new_base)
+        if key.startswith('__'):
+            raise AttributeError(key)
+        child = self._children.get(key)
+        if child is None:
+            if len(self._children) >= MAX_CHILDREN:
+                self._children.clear()
+            new_base = urljoin(self.the_url, key)
+            child = self.__class__(the_url=new_base, session=self.session)
+            self._children[key] = child
+        return child
 
     def __getitem__(self, key):
         return self.__getattr__(key)
@@ -49,25 +110,25 @@ class GenericAPI(object):
     def __call__(self, method='GET', payload=None, **kwargs):
         if payload is None:
             payload = {}
-        url = self.the_url
-        print("Calling {0} on {1}".format(method, url))
-        if method is 'GET':
-            return get(url, **kwargs)
-        elif method is 'PUT':
-            return put(url, payload, **kwargs)
-        elif method is 'POST':
-            return post(url, payload, **kwargs)
-        elif method is 'DELETE':
-            return delete(url, **kwargs)
+        logging.debug("Calling %s on %s", method, self.the_url)
+        if method == 'GET':
+            return self.get(**kwargs)
+        elif method == 'PUT':
+            return self.put(payload, **kwargs)
+        elif method == 'POST':
+            return self.post(payload, **kwargs)
+        elif method == 'DELETE':
+            return self.delete(**kwargs)
+        raise ValueError("Unsupported method {0}".format(method))
 
     def get(self, **kwargs):
-        return _get(self.the_url, **kwargs)
+        return _get(self.session, self.the_url, **kwargs)
 
     def post(self, payload, **kwargs):
-        return _post(self.the_url, payload, **kwargs)
+        return _post(self.session, self.the_url, payload, **kwargs)
 
     def put(self, payload=None, **kwargs):
-        return _put(self.the_url, payload, **kwargs)
+        return _put(self.session, self.the_url, payload, **kwargs)
 
     def delete(self, **kwargs):
-        return _delete(self.the_url, **kwargs)
+        return _delete(self.session, self.the_url, **kwargs)
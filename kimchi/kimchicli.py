@@ -15,227 +15,477 @@
 # limitations under the License.
 
 import argparse
+import asyncio
 import cmd
+import cProfile
+import json
 import logging
+import multiprocessing
+import os
+import pstats
 import random
-import string
+import signal
 import sys
+import time
+from collections import Counter
 from functools import partial
+from itertools import islice
 
 import Stemmer
 
-from hashlib import sha1
-from kimchi.genericapi import GenericAPI as Connector
-from kimchi.arangodbapi import (Arango, ArangoError, Document, Edge,
-                                SimpleQuery, Traversal)
+from kimchi import bench, server, stats
+from kimchi.asyncapi import DEF_CONCURRENCY, AsyncTransport
+from kimchi.cache import DEF_CACHE_SIZE, LRUCache, TaggedLRUCache
+from kimchi.backends import (DEF_DATADIR, DEF_URL, ArangoBackend,
+                             MemoryBackend)
+from kimchi.chunker import Chunker, init_worker, merge_batches, prepare_lines
+from kimchi.compact import (DAY, DEF_COMPACT_INTERVAL, DEF_GRACE,
+                            DEF_MIN_COUNT, Compaction, Compactor)
+from kimchi.compiled import CompiledBackend, compile_brain, compiled_path
+from kimchi.corpus import CorpusReader
+from kimchi.fakearango import FakeArangoServer
+from kimchi.genericapi import DEF_POOL_SIZE, GenericAPI as Connector, Timeout
+from kimchi.learner import BufferedLearner
+from kimchi.pools import DEF_POOL_REPLIES, DEF_POOL_STEMS, ReplyPools
+from kimchi.registry import DEF_MAX_BRAINS, BrainRegistry
+from kimchi.rarity import WordCounts
+from kimchi.stats import metrics
+from kimchi.snapshot import (SNAPSHOT_SUFFIX, export_brain,
+                             import_brain)
+from kimchi.scoring import (SCORERS, Candidates, IDFScorer, RarityScorer,
+                            Scorer)
+from kimchi.walker import DEF_CHAIN_SAMPLES
 
 DEF_CHAIN_ORDER = 2
+DEF_BATCH_SIZE = 1000
 MAX_REPLIES = 30
+MAX_SEEDS = 10
+SEED_SAMPLE = 100
 MAX_REPLY_LENGTH = 20
-PUNCTUATION_MAP = str.maketrans({p: '' for p in string.punctuation})
+WALKERS = ('traversal', 'random')
+SEEDINGS = ('word', 'context')
+BACKENDS = {
+    'arango': ArangoBackend,
+    'memory': MemoryBackend,
+    'compiled': CompiledBackend,
+}
+
+
+def time_left(deadline):
+    if deadline is not None:
+        return max(deadline - time.time(), 0.001)
+
+
+def expired(deadline):
+    return deadline is not None and time.time() >= deadline
 
 
 class Brain(object):
     def __init__(self, dbname="chains", chainorder=DEF_CHAIN_ORDER,
-                 stemmer='english'):
-        conn = Connector('http://127.0.0.1:8529')
-        sysdb = Arango(conn._db._system._api.database)
-        try:
-            sysdb.create({'name': dbname})
-        except ArangoError as e:
-            if e.code != 409:
-                raise
-        db = conn._db[dbname]
-        self.docs = Document(db)
-        self.edges = Edge(db)
-        self.simple_query = SimpleQuery(db)
-        self.traversal = Traversal(db)
-
-        self.collection_name = "chains"
-        self.edge_collection_name = "links"
-        self.control_collection_name = "control"
+                 stemmer='english', pool_size=DEF_POOL_SIZE,
+                 cache_size=DEF_CACHE_SIZE, backend=None,
+                 walker='traversal', chain_samples=DEF_CHAIN_SAMPLES,
+                 url=DEF_URL, scorer='length', conn=None,
+                 seeding='word'):
+        if backend is None:
+            backend = ArangoBackend(dbname, url=url, pool_size=pool_size,
+                                    conn=conn)
+        self.backend = backend
+        # seed nodes by stem and word chains by (node handle, direction),
+        # tagged with (direction, handle) for every node their search visited
+        self.node_cache = LRUCache(cache_size)
+        self.chain_cache = TaggedLRUCache(cache_size)
+
         self.chainorder = self.get_or_set_brain_info('chainorder', chainorder)
         self.stop = self.get_or_set_brain_info('stop', '////////')
-        stemmer_type = self.get_or_set_brain_info('stemmer', stemmer)
-        self.stemmer = Stemmer.Stemmer(stemmer_type)
+        self.stemmer_type = self.get_or_set_brain_info('stemmer', stemmer)
+        self.chunker = Chunker(self.chainorder, self.stop, self.stemmer_type)
+        self.stemmer = self.chunker.stemmer
+        # 'traversal' finds every chain from a node, 'random' samples some
+        self.walker = self.get_or_set_brain_info('walker', walker)
+        self.chain_samples = chain_samples
+        # 'word' seeds replies from single words, 'context' first from the
+        # longest run of the message's words that starts any nodes
+        self.seeding = seeding
+        self.learner = None
+        self.compactor = None
+        # counts are only loaded up front for the scorers that need them
+        self.counts = WordCounts(self.backend.load_counts)
+        if scorer == 'rarity':
+            self.scorer = RarityScorer(self.get_word_frequency)
+            self.counts.ensure_loaded()
+        elif scorer == 'idf':
+            self.scorer = IDFScorer(self.get_word_frequency, self.counts.idf)
+            self.counts.ensure_loaded()
+        else:
+            self.scorer = Scorer()
+        self.pools = ReplyPools(self)
+
+    def close(self):
+        if self.learner is not None:
+            self.learner.close()
+        if self.compactor is not None:
+            self.compactor.close()
+        self.pools.close()
+        self.backend.close()
+
+    def buffer_learning(self, **kwargs):
+        # learn() then queues messages to be written in the background
+        self.learner = BufferedLearner(self, **kwargs)
+        return self.learner
+
+    def precompute_replies(self, stems=DEF_POOL_STEMS, **kwargs):
+        # reply pools for the most frequent stems are then kept up to date
+        # in the background
+        self.pools.start(stems, **kwargs)
+        return self.pools
+
+    def compact(self, dry_run=False, **kwargs):
+        # nothing cached can be trusted afterwards, as compaction can change
+        # handles as well as chains
+        compaction = Compaction(**kwargs)
+        with metrics.phase('compact'):
+            compaction.plan(self.backend)
+            if dry_run:
+                return compaction
+            compaction.apply(self.backend, self.chunker)
+        for cache in (self.node_cache, self.chain_cache):
+            cache.clear()
+        self.pools.touch(compaction.stems())
+        return compaction
+
+    def schedule_compaction(self, interval=DEF_COMPACT_INTERVAL, lock=None,
+                            **kwargs):
+        self.compactor = Compactor(self, interval, lock, **kwargs).start()
+        return self.compactor
+
+    def flush(self):
+        if self.learner is not None:
+            self.learner.flush()
 
     def stemWord(self, word):
-        return self.stemmer.stemWord(word.lower().translate(PUNCTUATION_MAP))
+        with metrics.phase('stem'):
+            return self.chunker.stemWord(word)
 
     def get_or_set_brain_info(self, key, value):
-        collection = self.control_collection_name
-        try:
-            docs = self.simple_query.by_example(
-                collection, {'_key': key})
-        except KeyError:
-            docs = []
-        if docs:
-            return docs[0]['value']
-        doc = self.docs.create(
-            {'_key': key, 'value': value},
-            params={'collection': collection, 'createCollection': True})
-        return value
+        return self.backend.get_or_set_info(key, value)
+
+    def node_key(self, node):
+        return self.chunker.node_key(node)
+
+    def make_nodes(self, nodegenerator):
+        with metrics.phase('chunk'):
+            return self.chunker.make_nodes(nodegenerator)
 
     def add_nodes(self, nodegenerator):
-        stemWord = self.stemWord
-        handles = []
-        collection = self.collection_name
-        nodes = [n for n in nodegenerator]
-        full_length = len(nodes)
-        for i, node in enumerate(nodes):
-            data = {
-                '_key': sha1(str(node).encode('utf8')).hexdigest(),
-                'base_word_stem': stemWord(node[0]),
-                'node': node,
-            }
-            full_data = {
-                'outbound_distance': full_length - i,  # distance to end
-                'inbound_distance': i + 1,  # distance from start
-            }
-            full_data.update(data)
-            try:
-                docres = self.docs.create(full_data, params={
-                    'collection': collection, 'createCollection': True})
-            except ArangoError:
-                docres = self.simple_query.by_example(collection, data)[0]
-                updated = False
-                for key in ('outbound_distance', 'inbound_distance'):
-                    if key not in docres:
-                        updated = True
-                    elif docres[key] < full_data[key]:
-                        full_data[key] = docres[key]
-                    elif docres[key] > full_data[key]:
-                        updated = True
-                if updated:
-                    self.docs.update(docres['_id'], full_data, params={
-                        'collection': collection})
-            handles.append(docres['_id'])
+        nodes = self.make_nodes(nodegenerator)
+        with metrics.phase('node_upsert'):
+            handles = self.backend.add_nodes(nodes)
+        self.add_prefixes(nodes, handles)
+        self.forget_nodes(nodes, handles)
         return handles
 
+    def add_prefixes(self, nodes, handles):
+        prefixes = self.chunker.index_prefixes(nodes, handles)
+        if prefixes:
+            with metrics.phase('prefix_update'):
+                self.backend.add_prefixes(prefixes)
+
     def add_edges(self, handles):
-        current_handle, *rest = handles
-        collection = self.edge_collection_name
-        for next_handle in rest:
-            data = {
-                '_key': sha1(
-                    str((current_handle, next_handle)).encode('utf8')
-                ).hexdigest(),
-            }
-            try:
-                self.edges.create(data, params={
-                    'collection': collection, 'createCollection': True,
-                    'from': current_handle, 'to': next_handle})
-            except ArangoError:
-                pass
-            current_handle = next_handle
-
-    def get_node_by_handle(self, handle):
-        return self.docs[handle]
-
-    def get_node_by_key(self, key):
-        return self.docs[self.collection_name][key]
-
-    def get_nodes_by_first_word(self, word):
-        return self.simple_query.by_example(
-            self.collection_name,
-            {'base_word_stem': self.stemWord(word)},
-            limit=10
-        )
-
-    def get_edge_by_handle(self, handle):
-        return self.edges[handle]
-
-    def get_edge_by_key(self, key):
-        return self.docs[self.edge_collection_name][key]
+        with metrics.phase('edge_upsert'):
+            self.backend.add_edges(handles)
+        self.forget_chains(zip(handles, handles[1:]))
+
+    def forget_chains(self, links):
+        # a new link can only extend the outbound chains whose search
+        # reached where it starts and the inbound ones that reached where
+        # it ends
+        tags = set()
+        for from_handle, to_handle in links:
+            tags.add(('outbound', from_handle))
+            tags.add(('inbound', to_handle))
+        self.chain_cache.invalidate_tagged(tags)
+
+    def forget_nodes(self, nodes, handles):
+        # new nodes join the cached seeds of their stems, taking the place of
+        # a random seed once there are enough, so that stems stay cached
+        # while they are learned
+        stems = {}
+        for doc, handle in zip(nodes, handles):
+            stems.setdefault(doc['base_word_stem'], set()).add(handle)
+        for stem, stem_handles in stems.items():
+            seeds = self.node_cache.peek(stem)
+            if seeds is None:
+                continue
+            seeds = list(seeds)
+            for handle in stem_handles.difference(seeds):
+                if len(seeds) < SEED_SAMPLE:
+                    seeds.append(handle)
+                else:
+                    seeds[random.randrange(SEED_SAMPLE)] = handle
+            self.node_cache.set(stem, seeds)
+        self.pools.touch(stems)
+
+    def cache_stats(self):
+        return {
+            'nodes': self.node_cache.stats(),
+            'chains': self.chain_cache.stats(),
+        }
+
+    def prepare_batch(self, msgs):
+        with metrics.phase('chunk'):
+            return self.chunker.prepare_batch(msgs)
+
+    def store_batch(self, nodes, edges, counts=None):
+        with metrics.phase('node_import'):
+            handles = self.backend.import_nodes(nodes) if nodes else {}
+        self.add_prefixes(nodes.values(), handles.values())
+        seen = int(time.time())
+        with metrics.phase('edge_import'):
+            self.backend.import_edges(
+                (handles[from_key], handles[to_key], count, seen)
+                for (from_key, to_key), count in edges.items())
+        self.forget_chains((handles[from_key], handles[to_key])
+                           for from_key, to_key in edges)
+        self.forget_nodes(list(nodes.values()),
+                          [handles[key] for key in nodes])
+        if counts:
+            self.add_counts(counts)
+
+    def learn_batch(self, msgs):
+        self.store_batch(*self.prepare_batch(msgs))
+
+    def get_nodes_by_first_word(self, word, timeout=None):
+        # a larger random sample of the stem's nodes is cached and seeds are
+        # drawn from it afresh each time
+        stem = self.stemWord(word)
+        nodes = self.node_cache.get(stem)
+        if nodes is None:
+            with metrics.phase('seed_lookup'):
+                nodes = self.backend.nodes_by_stem(stem, SEED_SAMPLE,
+                                                   timeout=timeout)
+            self.node_cache.set(stem, nodes)
+        return random.sample(nodes, min(MAX_SEEDS, len(nodes)))
+
+    def get_nodes_by_context(self, word_list, timeout=None):
+        # seeds from the longest runs of the message's words that start nodes
+        stems = self.chunker.stem_words(word_list)
+        runs = {}
+        for k in range(min(len(stems), self.chainorder + 1), 1, -1):
+            for i in range(len(stems) - k + 1):
+                runs.setdefault(' '.join(stems[i:i + k]), k)
+        if not runs:
+            return []
+        with metrics.phase('context_lookup'):
+            found = self.backend.nodes_by_prefix(list(runs), timeout=timeout)
+        if not found:
+            return []
+        longest = max(runs[prefix] for prefix in found)
+        nodes = sorted({handle for prefix, (count, handles) in found.items()
+                        if runs[prefix] == longest for handle in handles})
+        return random.sample(nodes, min(MAX_SEEDS, len(nodes)))
+
+    def get_word_frequency(self, word):
+        return self.counts.stem(self.stemWord(word))
+
+    def add_counts(self, words):
+        stems = Counter()
+        with metrics.phase('stem'):
+            stemmed = self.chunker.stem_words(list(words))
+        for stem, count in zip(stemmed, words.values()):
+            stems[stem] += count
+        with metrics.phase('count_update'):
+            self.backend.add_counts(words, stems)
+        self.counts.add(words, stems)
 
     def chunk_msg(self, msg):
-        words = [self.stop] + msg.split() + [self.stop] * self.chainorder
-        return (words[i:i + self.chainorder + 1]
-                for i in range(1 + len(words) - self.chainorder))
+        return self.chunker.chunk_msg(msg)
 
     def learn(self, msg, reply=False):
         if msg.startswith('#'):
             return 
+        if self.learner is not None:
+            self.learner.learn(msg)
+            return
         nodes_to_add = self.chunk_msg(msg)
         nodes = self.add_nodes(nodes_to_add)
         self.add_edges(nodes)
+        self.add_counts(Counter(msg.split()))
 
-    def get_word_chain(self, doc, direction):
-        visitor = """
-            if (! result || ! result.visited) { return; }
-            if (result.visited.vertices) {
-              result.visited.vertices.push(vertex.node[0]);
-            }
-            if (result.visited.paths) {
-              var cpath = [];
-              path.vertices.forEach(function (v) {
-                cpath.push(v.node[0]);
-              });
-              result.visited.paths.push(cpath);
-            }
-        """
-
-        filterfn = """
-            if (path && path.length + vertex.%s > %d) {
-              return 'exclude';
-            }
-        """ % (direction + "_distance", MAX_REPLY_LENGTH) 
-
-        result = self.traversal.traverse(
-            doc['_id'],
-            self.edge_collection_name,
-            direction=direction,
-            maxDepth=MAX_REPLY_LENGTH,
-            filterfn=filterfn,
-            visitor=visitor)
-
-        if 'result' not in result:
-            return []
-        paths = result['result']['visited']['paths']
-        returnpaths = [p[:-1] for p in paths if p[-1] == self.stop]
-        return returnpaths
-
-    def generate_candidate_reply(self, word_list):
-        sorted_words = sorted(word_list, key=len)[::-1]
-        replies = []
-        for word in sorted_words:
-            logging.debug(word)
-            docs = self.get_nodes_by_first_word(word)
-            random.shuffle(docs)
-            for doc in docs:
-                forward_words = self.get_word_chain(doc, "outbound")
-                reverse_words = self.get_word_chain(doc, "inbound")
-                for forward_chain in forward_words:
-                    for reverse_chain in reverse_words:
-                        reply = reverse_chain[::-1] + forward_chain[1:]
-                        replies.append((self.score(reply, word_list), reply))
-                if len(replies) > MAX_REPLIES:
+    def get_word_chain(self, node, direction, timeout=None):
+        # random walks are sampled afresh every time, or they would always
+        # give the same few chains
+        if self.walker == 'random':
+            with metrics.phase('random_walk'):
+                return self.backend.sample_chains(
+                    node, direction, self.stop, MAX_REPLY_LENGTH,
+                    samples=self.chain_samples, timeout=timeout)
+        paths = self.chain_cache.get((node, direction))
+        if paths is None:
+            visited = set()
+            with metrics.phase('traversal'):
+                paths = self.backend.word_chains(
+                    node, direction, self.stop, MAX_REPLY_LENGTH,
+                    timeout=timeout, visited=visited)
+            self.chain_cache.set((node, direction), paths,
+                                 {(direction, handle) for handle in visited})
+        return paths
+
+    def join_chains(self, forward_words, reverse_words, word_list):
+        with metrics.phase('score'):
+            return self.scorer.join(forward_words, reverse_words, word_list)
+
+    def node_replies(self, node, word_list, deadline=None):
+        forward_words = self.get_word_chain(
+            node, "outbound", timeout=time_left(deadline))
+        reverse_words = self.get_word_chain(
+            node, "inbound", timeout=time_left(deadline))
+        if expired(deadline):
+            raise Timeout("reply deadline reached")
+        return self.join_chains(forward_words, reverse_words, word_list)
+
+    def context_replies(self, word_list, deadline=None):
+        replies = Candidates()
+        try:
+            for node in self.get_nodes_by_context(
+                    word_list, timeout=time_left(deadline)):
+                if expired(deadline) or len(replies) > MAX_REPLIES:
+                    break
+                replies.extend(self.node_replies(node, word_list, deadline))
+        except Timeout:
+            logging.debug("reply deadline reached")
+        return replies
+
+    def pooled_replies(self, word_list):
+        # replies from the precomputed pools of the message's words, and the
+        # words without one, longest first
+        replies = Candidates()
+        missed = []
+        seen = set()
+        for word in sorted(word_list, key=len)[::-1]:
+            stem = self.stemWord(word)
+            if stem in seen:
+                continue
+            seen.add(stem)
+            pool = self.pools.get(stem)
+            if pool is None:
+                missed.append(word)
+                continue
+            with metrics.phase('score'):
+                replies.extend(self.scorer.rank(
+                    [words for score, words in pool], word_list))
+        return replies, missed
+
+    def generate_candidate_reply(self, word_list, deadline=None):
+        # candidates are gathered until MAX_REPLIES are found or the
+        # deadline passes, whichever comes first
+        self.counts.maybe_refresh()
+        if self.seeding == 'context':
+            replies = self.context_replies(word_list, deadline)
+            if replies.replies:
+                return replies.choice()
+        replies, sorted_words = self.pooled_replies(word_list)
+        try:
+            for word in sorted_words:
+                if expired(deadline) or len(replies) > MAX_REPLIES:
                     break
-            if len(replies) > MAX_REPLIES:
-                break
-        if replies:
-            return random.choice(sorted(replies)[::-1])[1]
+                logging.debug(word)
+                nodes = self.get_nodes_by_first_word(
+                    word, timeout=time_left(deadline))
+                random.shuffle(nodes)
+                for node in nodes:
+                    if expired(deadline) or len(replies) > MAX_REPLIES:
+                        break
+                    replies.extend(self.node_replies(node, word_list,
+                                                     deadline))
+        except Timeout:
+            logging.debug("reply deadline reached")
+        return replies.choice()
 
     def score(self, words, original):
-        if not words:
-            return 0.0
-        # words used less in the brain should improve score?
-        # sum(1 / len(self.get_nodes_by_first_word(w)) for w in words)
-        max_word_length = max(len(w) for w in words)
-        average_word_length = sum(len(w) for w in words) / len(words)
-        return (max_word_length * average_word_length *
-                len(set(words) - set(original)))
-
-    def generate_replies(self, msg):
+        return self.scorer.score(words, original)
+
+    def generate_replies(self, msg, deadline=None):
         words = msg.split()
-        #starttime = time.time()
-        #while time.time() - starttime < 0.25:
-        cr = self.generate_candidate_reply(words)
+        with metrics.phase('reply'):
+            cr = self.generate_candidate_reply(words, deadline=deadline)
         if not cr:
             cr = ["I have nothing to say about that"]
         return ' '.join(cr)
 
 
+class AsyncBrain(Brain):
+    def __init__(self, dbname="chains", chainorder=DEF_CHAIN_ORDER,
+                 stemmer='english', concurrency=DEF_CONCURRENCY, **kwargs):
+        super(AsyncBrain, self).__init__(dbname, chainorder, stemmer,
+                                         pool_size=concurrency, **kwargs)
+        self.transport = AsyncTransport(concurrency)
+
+    def close(self):
+        super(AsyncBrain, self).close()
+        self.transport.close()
+
+    def generate_candidate_reply(self, word_list, deadline=None):
+        self.counts.maybe_refresh()
+        if self.seeding == 'context':
+            replies = self.context_replies(word_list, deadline)
+            if replies.replies:
+                return replies.choice()
+        return asyncio.run(
+            self.agenerate_candidate_reply(word_list, deadline=deadline))
+
+    async def alookup(self, word, deadline):
+        nodes = await self.transport.call(
+            self.get_nodes_by_first_word, word, timeout=time_left(deadline))
+        random.shuffle(nodes)
+        return nodes
+
+    async def anode_replies(self, node, word_list, deadline):
+        forward_words, reverse_words = await asyncio.gather(
+            self.transport.call(self.get_word_chain, node, "outbound",
+                                timeout=time_left(deadline)),
+            self.transport.call(self.get_word_chain, node, "inbound",
+                                timeout=time_left(deadline)))
+        if expired(deadline):
+            raise Timeout("reply deadline reached")
+        return self.join_chains(forward_words, reverse_words, word_list)
+
+    async def agenerate_candidate_reply(self, word_list, deadline=None):
+        replies, sorted_words = self.pooled_replies(word_list)
+        if expired(deadline) or len(replies) > MAX_REPLIES:
+            return replies.choice()
+        lookups = {asyncio.ensure_future(self.alookup(word, deadline))
+                   for word in sorted_words}
+        chains = set()
+        try:
+            while lookups or chains:
+                if expired(deadline) or len(replies) > MAX_REPLIES:
+                    break
+                done, _ = await asyncio.wait(
+                    lookups | chains, timeout=time_left(deadline),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logging.debug("reply deadline reached")
+                    break
+                for task in done:
+                    if isinstance(task.exception(), Timeout):
+                        lookups.discard(task)
+                        chains.discard(task)
+                    elif task in lookups:
+                        lookups.discard(task)
+                        chains.update(
+                            asyncio.ensure_future(
+                                self.anode_replies(node, word_list, deadline))
+                            for node in task.result())
+                    else:
+                        chains.discard(task)
+                        replies.extend(task.result())
+        finally:
+            for task in lookups | chains:
+                task.cancel()
+        return replies.choice()
+
+
 def run():
     parser = argparse.ArgumentParser(description="A chat bot")
 
@@ -244,6 +494,16 @@ def run():
     db_parser.add_argument(
         '--dbname', default='chains',
         help="Specifies the brain database.")
+    db_parser.add_argument(
+        '--backend', choices=sorted(BACKENDS), default='arango',
+        help="Store the brain in ArangoDB, in memory (saved to a file named "
+             "after the brain database) or read it from a compiled file.")
+    db_parser.add_argument(
+        '--datadir', default=DEF_DATADIR,
+        help="Set the directory for brain files.")
+    db_parser.add_argument(
+        '--url', default=DEF_URL,
+        help="Set the ArangoDB server URL.")
 
     # simulation options
     note = ("Note that this option is overridden by database settings and "
@@ -255,13 +515,113 @@ def run():
     modelling_parser.add_argument(
         '--language', choices=Stemmer.algorithms(), default='english',
         help="Set the simulation language for the stemmer. " + note)
+    modelling_parser.add_argument(
+        '--walker', choices=WALKERS, default='traversal',
+        help="Find reply chains with a server-side traversal of every path "
+             "or by sampling random walks towards the end of a message. "
+             + note)
 
     # learning options
     learning_parser = argparse.ArgumentParser(add_help=False)
     learning_parser.add_argument(
-        'infile', metavar='INFILE', nargs='?', type=argparse.FileType('r'),
-        default=sys.stdin,
-        help="An input file from which to learn")
+        'infile', metavar='INFILE', nargs='?', type=argparse.FileType('rb'),
+        default='-',
+        help="An input file from which to learn. Learning a file records "
+             "how far it has got, and learning the same file again carries "
+             "on from there.")
+    learning_parser.add_argument(
+        '--bulk', action='store_true',
+        help="Learn in batches using the bulk import API.")
+    learning_parser.add_argument(
+        '--batch-size', type=int, default=DEF_BATCH_SIZE,
+        help="Set the number of lines per batch in bulk mode, and between "
+             "checkpoints.")
+    learning_parser.add_argument(
+        '--restart', action='store_true',
+        help="Learn the whole file, ignoring how far it was learned "
+             "before.")
+    learning_parser.add_argument(
+        '--complete', action='store_true',
+        help="Learn a last line without a newline too, rather than waiting "
+             "for it to be finished.")
+    learning_parser.add_argument(
+        '--workers', type=int, default=1,
+        help="Prepare batches on this many processes in bulk mode. Their "
+             "results are merged and written once per round of batches.")
+
+    # reply engine options
+    engine_parser = argparse.ArgumentParser(add_help=False)
+    engine_parser.add_argument(
+        '--concurrency', type=int, default=0,
+        help="Issue up to this many lookups and traversals concurrently "
+             "when replying. By default they are issued one at a time.")
+    engine_parser.add_argument(
+        '--reply-timeout', type=float, default=None,
+        help="Keep gathering candidate replies for this many seconds and "
+             "then reply with the best found so far.")
+    engine_parser.add_argument(
+        '--cache-size', type=int, default=DEF_CACHE_SIZE,
+        help="Keep up to this many seed lookups and word chains in memory. "
+             "Set to 0 to disable caching.")
+    engine_parser.add_argument(
+        '--scorer', choices=SCORERS, default='length',
+        help="Score replies on word length and novelty, or also favour "
+             "words that are rare in the brain, weighted by inverse count or "
+             "inverse document frequency.")
+    engine_parser.add_argument(
+        '--learn-queue', type=int, default=0,
+        help="Queue up to this many learned messages and write them in "
+             "batches in the background. By default each message is written "
+             "before the next is read.")
+    engine_parser.add_argument(
+        '--seeding', choices=SEEDINGS, default='word',
+        help="Seed replies from single words of the message, or first from "
+             "the longest run of its words that the brain has learned.")
+    engine_parser.add_argument(
+        '--chain-samples', type=int, default=DEF_CHAIN_SAMPLES,
+        help="Set the number of chains sampled from each node by the random "
+             "walker.")
+
+    # long-running reply options
+    serving_parser = argparse.ArgumentParser(add_help=False)
+    serving_parser.add_argument(
+        '--precompute', type=int, default=0,
+        help="Keep reply pools for this many of the most frequent stems, "
+             "built and refreshed in the background as learning changes "
+             "them. By default only pools stored by the precompute command "
+             "are used, until learning changes them.")
+    serving_parser.add_argument(
+        '--max-brains', type=int, default=DEF_MAX_BRAINS,
+        help="Keep up to this many brains open when switching between "
+             "databases, closing the least recently used beyond that.")
+    serving_parser.add_argument(
+        '--brain-idle-timeout', type=float, default=None,
+        help="Close brains that have not been used for this many seconds.")
+
+    # compaction options
+    compaction_parser = argparse.ArgumentParser(add_help=False)
+    compaction_parser.add_argument(
+        '--min-count', type=int, default=DEF_MIN_COUNT,
+        help="Remove nodes and links learned fewer than this many times.")
+    compaction_parser.add_argument(
+        '--grace', type=float, default=DEF_GRACE / DAY,
+        help="Keep everything seen within this many days of the last thing "
+             "learned.")
+    compaction_parser.add_argument(
+        '--max-age', type=float, default=None,
+        help="Also remove nodes and links not seen for this many days, "
+             "however often they were learned.")
+
+    # diagnostic options
+    diagnostics_parser = argparse.ArgumentParser(add_help=False)
+    diagnostics_parser.add_argument(
+        '--stats', action='store_true',
+        help="Time requests and brain phases and print the results in the "
+             "Prometheus text format on exit.")
+    diagnostics_parser.add_argument(
+        '--profile', metavar='FILE', default=None,
+        help="Run the command under cProfile and save the profile to FILE, "
+             "or print the top functions if FILE is -.")
 
     # reply options
     reply_parser = argparse.ArgumentParser(add_help=False)
@@ -275,19 +635,145 @@ def run():
     ### learn command ###
     learn_subparser = subparsers.add_parser(
         'learn', help="add source data to the corpus",
-        parents=[learning_parser, db_parser, modelling_parser])
+        parents=[learning_parser, db_parser, modelling_parser,
+                 diagnostics_parser])
     learn_subparser.set_defaults(func=do_learn)
 
     ### response command
     reply_subparser = subparsers.add_parser(
         'reply', help="send a message to get a reply back",
-        parents=[reply_parser, db_parser, modelling_parser])
+        parents=[reply_parser, db_parser, modelling_parser, engine_parser,
+                 diagnostics_parser])
     reply_subparser.set_defaults(func=do_response)
 
+    ### compile command
+    compile_subparser = subparsers.add_parser(
+        'compile', help="write a compiled, read-only copy of a brain",
+        parents=[db_parser, diagnostics_parser])
+    compile_subparser.add_argument(
+        '--out', default=None,
+        help="Set the compiled brain file. Defaults to DBNAME.kmc in the "
+             "data directory.")
+    compile_subparser.set_defaults(func=do_compile)
+
+    ### precompute command
+    precompute_subparser = subparsers.add_parser(
+        'precompute', help="store reply pools for the most frequent stems",
+        parents=[db_parser, engine_parser, diagnostics_parser])
+    precompute_subparser.add_argument(
+        '--stems', type=int, default=DEF_POOL_STEMS,
+        help="Set the number of stems to build reply pools for.")
+    precompute_subparser.add_argument(
+        '--replies-per-stem', type=int, default=DEF_POOL_REPLIES,
+        help="Set the number of replies kept in each pool.")
+    precompute_subparser.set_defaults(func=do_precompute)
+
+    ### compact command
+    compact_subparser = subparsers.add_parser(
+        'compact', help="remove rarely used and stale chains from a brain",
+        parents=[db_parser, compaction_parser, diagnostics_parser])
+    compact_subparser.add_argument(
+        '--dry-run', action='store_true',
+        help="Report what would be removed without changing the brain.")
+    compact_subparser.set_defaults(func=do_compact)
+
+    ### export command
+    export_subparser = subparsers.add_parser(
+        'export', help="write a brain to a snapshot file",
+        parents=[db_parser, diagnostics_parser])
+    export_subparser.add_argument(
+        '--out', default=None,
+        help="Set the snapshot file. Defaults to DBNAME{0} in the data "
+             "directory.".format(SNAPSHOT_SUFFIX))
+    export_subparser.set_defaults(func=do_export)
+
+    ### import command
+    import_subparser = subparsers.add_parser(
+        'import', help="load a snapshot file into a brain",
+        parents=[db_parser, diagnostics_parser])
+    import_subparser.add_argument(
+        'snapshot', metavar='SNAPSHOT',
+        help="A snapshot written by the export command. It is merged into "
+             "any chains the brain already has.")
+    import_subparser.set_defaults(func=do_import)
+
+    ### bench command
+    bench_subparser = subparsers.add_parser(
+        'bench', help="benchmark learning and replying on a synthetic corpus",
+        parents=[db_parser, modelling_parser, engine_parser,
+                 diagnostics_parser])
+    bench_subparser.add_argument(
+        '--lines', type=int, default=bench.DEF_LINES,
+        help="Set the number of lines in the corpus.")
+    bench_subparser.add_argument(
+        '--vocabulary', type=int, default=bench.DEF_VOCABULARY,
+        help="Set the number of distinct words in the corpus.")
+    bench_subparser.add_argument(
+        '--skew', type=float, default=bench.DEF_SKEW,
+        help="Set the Zipf exponent of word frequencies. Higher values "
+             "share common words between more chains.")
+    bench_subparser.add_argument(
+        '--max-words', type=int, default=bench.DEF_MAX_WORDS,
+        help="Set the maximum number of words per line.")
+    bench_subparser.add_argument(
+        '--replies', type=int, default=bench.DEF_REPLIES,
+        help="Set the number of messages to reply to.")
+    bench_subparser.add_argument(
+        '--bulk', action='store_true',
+        help="Learn in batches using the bulk import API.")
+    bench_subparser.add_argument(
+        '--batch-size', type=int, default=DEF_BATCH_SIZE,
+        help="Set the number of lines per batch in bulk mode.")
+    bench_subparser.add_argument(
+        '--seed', type=int, default=0,
+        help="Set the random seed for the corpus and replies.")
+    bench_subparser.add_argument(
+        '--fake', action='store_true',
+        help="Run against an in-process stand-in for ArangoDB instead of "
+             "the server at --url.")
+    bench_subparser.add_argument(
+        '--out', type=argparse.FileType('w'), default=sys.stdout,
+        help="Write the JSON report to this file.")
+    bench_subparser.set_defaults(func=do_bench, dbname=bench.DEF_DBNAME)
+
+    ### serve command
+    serve_subparser = subparsers.add_parser(
+        'serve', help="serve replies and learn messages over a socket",
+        parents=[db_parser, modelling_parser, engine_parser, serving_parser,
+                 compaction_parser, diagnostics_parser])
+    serve_subparser.add_argument(
+        '--compact-interval', type=float, default=None,
+        help="Compact brains in the background every this many hours.")
+    serve_subparser.add_argument(
+        '--protocol', choices=server.PROTOCOLS, default='http',
+        help="Accept JSON requests over HTTP (POST /reply or /learn) or as "
+             "newline-delimited JSON objects with an op of reply or learn.")
+    serve_subparser.add_argument(
+        '--host', default=server.DEF_HOST,
+        help="Set the address to listen on.")
+    serve_subparser.add_argument(
+        '--port', type=int, default=server.DEF_PORT,
+        help="Set the port to listen on.")
+    serve_subparser.add_argument(
+        '--unix-socket', default=None,
+        help="Listen on this unix socket instead of a TCP port.")
+    serve_subparser.add_argument(
+        '--workers', type=int, default=server.DEF_WORKERS,
+        help="Handle up to this many requests at once.")
+    serve_subparser.add_argument(
+        '--allow-brain', metavar='DBNAME', action='append', default=[],
+        help="Let requests name this brain as well as --dbname. May be "
+             "given more than once.")
+    serve_subparser.add_argument(
+        '--allow-any-brain', action='store_true',
+        help="Let requests name any brain, creating it if need be.")
+    serve_subparser.set_defaults(func=do_serve)
+
     ### shell command
     shell_subparser = subparsers.add_parser(
         'shell', help="enter an interactive shell",
-        parents=[db_parser, modelling_parser])
+        parents=[db_parser, modelling_parser, engine_parser, serving_parser,
+                 diagnostics_parser])
     shell_subparser.set_defaults(func=do_shell)
 
     dargs = vars(parser.parse_args())
@@ -296,31 +782,274 @@ def run():
         if dargs.get(option):
             dargs[option] = [x for xs in dargs[option] for x in xs]
 
-    dargs['func'](dargs)
+    if dargs['stats'] or dargs['subcommand'] == 'serve':
+        stats.enable()
+    if dargs['profile']:
+        profile(dargs)
+    else:
+        dargs['func'](dargs)
+    if dargs['stats']:
+        sys.stderr.write(stats.metrics.prometheus())
+
+
+def profile(dargs):
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(dargs['func'], dargs)
+    finally:
+        if dargs['profile'] == '-':
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+                'cumulative').print_stats(30)
+        else:
+            profiler.dump_stats(dargs['profile'])
 
 
 def do_learn(dargs):
     # TODO - add sensible behaviour for when no files are specified (stdin?)
     brain = get_brain(dargs)
-    for i, msg in enumerate(dargs['infile']):
-        if i % 100 == 0:
-            logging.debug(i)
-        brain.learn(msg)
+    # a checkpoint is recorded after each batch is written
+    reader = CorpusReader(dargs['infile'], brain.backend,
+                          resume=not dargs['restart'],
+                          complete=dargs['complete'])
+    batches = reader.batches(max(1, dargs['batch_size']))
+    if dargs['bulk'] and dargs['workers'] > 1:
+        learn_parallel(brain, batches, dargs['workers'], reader.commit)
+    elif dargs['bulk']:
+        for batch in batches:
+            brain.learn_batch(batch)
+            reader.commit()
+            logging.debug(reader.lines)
+    else:
+        for batch in batches:
+            for msg in batch:
+                brain.learn(msg)
+            reader.commit()
+            logging.debug(reader.lines)
+    brain.close()
+
+
+def learn_parallel(brain, batches, workers, commit=None):
+    # each round hands one batch to every worker, then merges the results
+    # (smallest distances, union of links) into a single write
+    with multiprocessing.Pool(workers, initializer=init_worker,
+                              initargs=(brain.chunker,)) as pool:
+        for batch_round in iter(lambda: list(islice(batches, workers)), []):
+            brain.store_batch(
+                *merge_batches(pool.map(prepare_lines, batch_round)))
+            if commit is not None:
+                commit()
 
 
 def do_response(dargs):
     brain = get_brain(dargs)
     for msg in dargs['message'] if dargs['message'] else []:
-        print(brain.generate_replies(msg))
+        print(brain.generate_replies(
+            msg, deadline=get_deadline(dargs.get('reply_timeout'))))
+
+
+def do_compile(dargs):
+    brain = get_brain(dargs)
+    out = dargs['out'] or compiled_path(dargs['dbname'], dargs['datadir'])
+    info = {
+        'chainorder': brain.chainorder,
+        'stop': brain.stop,
+        'stemmer': brain.stemmer_type,
+        'walker': brain.walker,
+    }
+    nodes, edges = compile_brain(brain.backend, info, out)
+    logging.info("Compiled %d nodes and %d links to %s", nodes, edges, out)
+    brain.close()
+
+
+def do_export(dargs):
+    backend = open_backend(dargs)
+    out = dargs['out'] or os.path.join(dargs['datadir'],
+                                       dargs['dbname'] + SNAPSHOT_SUFFIX)
+    nodes, edges = export_brain(backend, out)
+    logging.info("Exported %d nodes and %d links to %s", nodes, edges, out)
+    backend.close()
+
+
+def do_import(dargs):
+    backend = open_backend(dargs)
+    nodes, edges = import_brain(backend, dargs['snapshot'])
+    logging.info("Imported %d nodes and %d links into %s", nodes, edges,
+                 dargs['dbname'])
+    backend.close()
+
+
+def do_precompute(dargs):
+    brain = get_brain(dargs)
+    brain.pools.size = max(1, dargs['replies_per_stem'])
+    stems = brain.pools.top_stems(dargs['stems'])
+    pools = brain.pools.precompute(stems)
+    logging.info("Stored reply pools for %d of %d stems", len(pools),
+                 len(stems))
+    brain.close()
+
+
+def compaction_options(dargs):
+    return {
+        'min_count': dargs['min_count'],
+        'grace': dargs['grace'] * DAY,
+        'max_age': (dargs['max_age'] * DAY
+                    if dargs['max_age'] is not None else None),
+    }
+
+
+def do_compact(dargs):
+    brain = get_brain(dargs)
+    compaction = brain.compact(dry_run=dargs['dry_run'],
+                               **compaction_options(dargs))
+    logging.info("%s %d nodes and %d links and %s the distances of %d of "
+                 "the %d nodes left",
+                 "Would remove" if dargs['dry_run'] else "Removed",
+                 len(compaction.nodes), len(compaction.links),
+                 "would update" if dargs['dry_run'] else "updated",
+                 len(compaction.distances), compaction.kept)
+    brain.close()
+
+
+def do_bench(dargs):
+    server = None
+    if dargs['fake'] and dargs['backend'] == 'arango':
+        server = FakeArangoServer().start()
+        dargs['url'] = server.url
+    # the brain is learned from scratch and dropped afterwards, so it must
+    # not hold anything already
+    brain = get_brain(dargs)
+    if next(brain.backend.iter_nodes(), None) is not None:
+        brain.close()
+        if server is not None:
+            server.stop()
+        sys.exit("Brain {0} is not empty, so it cannot be used for "
+                 "benchmarking".format(dargs['dbname']))
+    try:
+        report = bench.run_benchmark(
+            brain, dargs['lines'], dargs['vocabulary'], dargs['skew'],
+            dargs['max_words'], dargs['replies'], dargs['bulk'],
+            max(1, dargs['batch_size']), dargs['reply_timeout'],
+            dargs['seed'])
+    finally:
+        brain.close()
+        brain.backend.drop()
+        if server is not None:
+            server.stop()
+    report['config'] = {
+        'backend': dargs['backend'],
+        'fake': server is not None,
+        'walker': brain.walker,
+        'chain_order': brain.chainorder,
+        'concurrency': dargs['concurrency'],
+        'cache_size': dargs['cache_size'],
+    }
+    json.dump(report, dargs['out'], indent=2, sort_keys=True)
+    dargs['out'].write('\n')
+
+
+def do_serve(dargs):
+    # brains share a database connection pool sized to match the workers
+    conn = get_connection(dict(dargs, pool_size=dargs['workers']))
+
+    def factory(dbname):
+        return get_brain(dict(dargs, dbname=dbname, learn_queue=0,
+                              precompute=0, pool_size=dargs['workers'],
+                              conn=conn))
+
+    compaction = None
+    if dargs['compact_interval']:
+        compaction = dict(compaction_options(dargs),
+                          interval=dargs['compact_interval'] * 60 * 60)
+    service = server.ReplyService(factory, dargs['dbname'],
+                                  dargs['reply_timeout'],
+                                  shared=dargs['backend'] == 'arango',
+                                  learn_queue=dargs['learn_queue'],
+                                  precompute=dargs['precompute'],
+                                  compaction=compaction,
+                                  max_brains=dargs['max_brains'],
+                                  idle_timeout=dargs['brain_idle_timeout'],
+                                  allowed=dargs['allow_brain'],
+                                  allow_any=dargs['allow_any_brain'])
+    service.get()
+    httpd = server.make_server(service, dargs['protocol'], dargs['host'],
+                               dargs['port'], dargs['unix_socket'],
+                               dargs['workers'])
+    logging.info("Serving %s on %s", dargs['dbname'],
+                 dargs['unix_socket'] or
+                 '{0}:{1}'.format(dargs['host'], dargs['port']))
+    # queued learns are written out on the way down
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.close()
 
 
 def do_shell(dargs):
-    BrainShell(dargs).cmdloop()
+    shell = BrainShell(dargs)
+    shell.cmdloop()
+    shell.registry.close()
+
+
+def get_deadline(timeout):
+    if timeout is not None:
+        return time.time() + timeout
+
+
+def get_connection(dargs):
+    # a connection for brains in ArangoDB to share
+    if dargs.get('backend', 'arango') == 'arango':
+        pool_size = max(dargs.get('pool_size', DEF_POOL_SIZE),
+                        dargs.get('concurrency') or 0)
+        return Connector(dargs.get('url', DEF_URL), pool_size=pool_size)
+
+
+def get_backend(dargs):
+    backend = dargs.get('backend', 'arango')
+    if backend == 'arango':
+        return None
+    return BACKENDS[backend](dargs['dbname'],
+                             datadir=dargs.get('datadir', DEF_DATADIR))
+
+
+def open_backend(dargs):
+    # the backend on its own, for commands that move chains around without
+    # a Brain setting up its control info
+    backend = get_backend(dargs)
+    if backend is None:
+        backend = ArangoBackend(dargs['dbname'],
+                                url=dargs.get('url', DEF_URL))
+    return backend
 
 
 def get_brain(dargs):
-    return Brain(dargs['dbname'], dargs['chain_order'],
-                 stemmer=dargs['language'])
+    kwargs = {
+        'stemmer': dargs.get('language', 'english'),
+        'cache_size': dargs.get('cache_size', DEF_CACHE_SIZE),
+        'backend': get_backend(dargs),
+        'walker': dargs.get('walker', 'traversal'),
+        'chain_samples': dargs.get('chain_samples', DEF_CHAIN_SAMPLES),
+        'url': dargs.get('url', DEF_URL),
+        'scorer': dargs.get('scorer', 'length'),
+        'conn': dargs.get('conn'),
+        'seeding': dargs.get('seeding', 'word'),
+    }
+    chainorder = dargs.get('chain_order', DEF_CHAIN_ORDER)
+    if dargs.get('concurrency'):
+        brain = AsyncBrain(dargs['dbname'], chainorder,
+                           concurrency=dargs['concurrency'], **kwargs)
+    else:
+        brain = Brain(dargs['dbname'], chainorder,
+                      pool_size=dargs.get('pool_size', DEF_POOL_SIZE),
+                      **kwargs)
+    if dargs.get('learn_queue'):
+        brain.buffer_learning(queue_size=dargs['learn_queue'])
+    if dargs.get('precompute'):
+        brain.precompute_replies(dargs['precompute'])
+    return brain
 
 
 class BrainShell(cmd.Cmd):
@@ -337,7 +1066,14 @@ class BrainShell(cmd.Cmd):
     prompt = "kimchi> "
 
     def __init__(self, dargs, *args, **kwargs):
-        self.brain = get_brain(dargs)
+        # brains switched to with setbrain are kept open
+        self.dargs = dict(dargs, conn=get_connection(dargs))
+        self.dbname = dargs['dbname']
+        self.registry = BrainRegistry(self.open_brain,
+                                      dargs.get('max_brains', DEF_MAX_BRAINS),
+                                      dargs.get('brain_idle_timeout'))
+        self.registry.get(self.dbname)
+        self.reply_timeout = dargs.get('reply_timeout')
         self.last_line = None
         super(BrainShell, self).__init__(*args, **kwargs)
 
@@ -359,18 +1095,44 @@ class BrainShell(cmd.Cmd):
         if self.last_line is not None:
             self.do_reply(self.last_line)
 
+    @property
+    def brain(self):
+        return self.registry.get(self.dbname)
+
+    def open_brain(self, dbname, **kwargs):
+        return get_brain(dict(self.dargs, dbname=dbname, **kwargs))
+
     def do_setbrain(self, line):
         sl = line.split()
         db, c_o = sl[:2] if len(sl) > 1 else (sl[0], DEF_CHAIN_ORDER)
-        self.brain = get_brain({'dbname': db, 'chain_order': c_o})
+        self.registry.get(db, chain_order=int(c_o))
+        self.dbname = db
 
     def do_learn(self, line):
         self.last_line = None
         self.brain.learn(line)
 
+    def do_stats(self, line):
+        for name, stats in sorted(self.brain.cache_stats().items()):
+            print("{0} cache: {size}/{maxsize} entries, {hits} hits, "
+                  "{misses} misses".format(name, **stats))
+        if self.brain.learner is not None:
+            print("learn queue: {depth} waiting, {learned}/{queued} learned "
+                  "in {batches} batches ({nodes} nodes, {edges} links), "
+                  "{errors} errors".format(**self.brain.learner.stats()))
+        print("brains: {open} open, {loaded} loaded, {evicted} "
+              "evicted".format(**self.registry.stats()))
+        print("reply pools: {stems} stems, {stale} stale, {hits} hits, "
+              "{misses} misses".format(**self.brain.pools.stats()))
+
+    def do_metrics(self, line):
+        stats.enable()
+        print(stats.metrics.prometheus(), end='')
+
     def do_reply(self, line):
         self.last_line = None
-        reply = self.brain.generate_replies(line)
+        reply = self.brain.generate_replies(
+            line, deadline=get_deadline(self.reply_timeout))
         print(reply)
 
 
@@ -0,0 +1,117 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Write-behind learning.
+#
+# Messages are queued and written by a background thread in batches. Each
+# batch is everything that arrived within the flush window (up to a batch
+# size), chunked together so that nodes and links shared between messages
+# are written once. A full queue blocks the caller, or raises queue.Full
+# when it asked not to block, so a slow database pushes back on ingestion.
+
+import contextlib
+import logging
+import queue
+import threading
+import time
+
+DEF_QUEUE_SIZE = 10000
+DEF_BATCH_SIZE = 1000
+DEF_FLUSH_INTERVAL = 0.5
+
+
+class BufferedLearner(object):
+    def __init__(self, brain, queue_size=DEF_QUEUE_SIZE,
+                 batch_size=DEF_BATCH_SIZE,
+                 flush_interval=DEF_FLUSH_INTERVAL, lock=None):
+        self.brain = brain
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.lock = contextlib.nullcontext() if lock is None else lock
+        self.queue = queue.Queue(queue_size)
+        self.closed = False
+        self.queued = 0
+        self.learned = 0
+        self.batches = 0
+        self.nodes = 0
+        self.edges = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def learn(self, msg, block=True, timeout=None):
+        if self.closed:
+            raise ValueError("learner is closed")
+        self.queue.put(msg, block, timeout)
+        self.queued += 1
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'queued': self.queued,
+            'learned': self.learned,
+            'batches': self.batches,
+            'nodes': self.nodes,
+            'edges': self.edges,
+            'errors': self.errors,
+        }
+
+    def next_batch(self):
+        # blocks for the first message, then takes whatever else arrives
+        # within the flush window
+        batch = [self.queue.get()]
+        deadline = time.time() + self.flush_interval
+        while batch[-1] is not None and len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get(
+                    timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            msgs = [msg for msg in batch if msg is not None]
+            try:
+                if msgs:
+                    self.write(msgs)
+            finally:
+                for msg in batch:
+                    self.queue.task_done()
+            if len(msgs) < len(batch):
+                break
+
+    def write(self, msgs):
+        try:
+            nodes, edges, counts = self.brain.prepare_batch(msgs)
+            with self.lock:
+                self.brain.store_batch(nodes, edges, counts)
+        except Exception:
+            self.errors += 1
+            logging.exception("Failed to learn %d messages", len(msgs))
+            return
+        self.learned += len(msgs)
+        self.batches += 1
+        self.nodes += len(nodes)
+        self.edges += len(edges)
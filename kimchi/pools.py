@@ -0,0 +1,139 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Precomputed reply pools.
+#
+# A pool holds the best replies joined from the chains through a stem's
+# nodes, scored without regard to any message. Replying to a word with a
+# pool only means rescoring the pool against the message, rather than
+# looking up seeds and walking chains. Pools are built for the most
+# frequent stems by `kimchi precompute` or by a background thread in a
+# long-running brain, and are stored with the brain so that every process
+# opening it can use them. Learning new nodes for a stem makes its pool
+# stale: the background thread rebuilds stale pools, and without one they
+# are dropped so replies fall back to walking the chains.
+
+import contextlib
+import logging
+import threading
+
+from kimchi.scoring import Candidates
+from kimchi.stats import metrics
+
+DEF_POOL_STEMS = 100
+DEF_POOL_REPLIES = 100
+DEF_POOL_SEEDS = 10
+DEF_REFRESH_INTERVAL = 60
+
+
+class ReplyPools(object):
+    def __init__(self, brain, size=DEF_POOL_REPLIES, seeds=DEF_POOL_SEEDS):
+        self.brain = brain
+        self.size = size
+        self.seeds = seeds
+        # pools by stem, as lists of [score, words]
+        self.pools = dict(brain.backend.load_pools())
+        self.stale = set()
+        self.mutex = threading.Lock()
+        self.lock = contextlib.nullcontext()
+        self.thread = None
+        self.closed = threading.Event()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, stem):
+        pool = self.pools.get(stem)
+        if pool is None:
+            self.misses += 1
+            metrics.inc('kimchi_reply_pool_lookups_total', result='miss')
+        else:
+            self.hits += 1
+            metrics.inc('kimchi_reply_pool_lookups_total', result='hit')
+        return pool
+
+    def touch(self, stems):
+        # stored pools are discarded too, so that they are not loaded as
+        # fresh later, but a rebuilding process serves its own until then
+        with self.mutex:
+            stems = [stem for stem in stems
+                     if stem in self.pools and stem not in self.stale]
+            if stems:
+                self.brain.backend.discard_pools(stems)
+            if self.thread is None:
+                for stem in stems:
+                    del self.pools[stem]
+            else:
+                self.stale.update(stems)
+
+    def top_stems(self, count):
+        return [stem for stem, n in
+                self.brain.counts.most_common_stems(count) if stem]
+
+    def build(self, stem):
+        brain = self.brain
+        replies = Candidates(self.size)
+        for node in brain.backend.nodes_by_stem(stem, self.seeds):
+            replies.extend(brain.scorer.join(
+                brain.get_word_chain(node, "outbound"),
+                brain.get_word_chain(node, "inbound"), (), top=self.size))
+        return [[score, words] for score, words in replies.best()]
+
+    def precompute(self, stems):
+        pools = {}
+        for stem in stems:
+            with self.lock, metrics.phase('pool_build'):
+                pool = self.build(stem)
+            if pool:
+                pools[stem] = pool
+        if pools:
+            with self.lock:
+                self.brain.backend.store_pools(pools)
+        with self.mutex:
+            self.pools.update(pools)
+            self.stale.difference_update(stems)
+        return pools
+
+    def start(self, stems=DEF_POOL_STEMS, interval=DEF_REFRESH_INTERVAL,
+              lock=None):
+        # keeps pools for the most frequent stems and rebuilds stale ones
+        if lock is not None:
+            self.lock = lock
+        self.thread = threading.Thread(target=self.run,
+                                       args=(stems, interval), daemon=True)
+        self.thread.start()
+
+    def run(self, stems, interval):
+        while not self.closed.is_set():
+            with self.mutex:
+                wanted = ((set(self.top_stems(stems)) - set(self.pools)) |
+                          self.stale)
+            try:
+                self.precompute(wanted)
+            except Exception:
+                logging.exception("Failed to precompute %d reply pools",
+                                  len(wanted))
+            self.closed.wait(interval)
+
+    def close(self):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        return {
+            'stems': len(self.pools),
+            'stale': len(self.stale),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
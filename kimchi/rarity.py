@@ -0,0 +1,94 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Word and stem frequencies for scoring.
+#
+# Backends keep running totals of how often each word and stem has been
+# learned. A brain holds a snapshot of them, loaded when first needed, kept
+# up to date with its own learning and reloaded in the background now and
+# then to pick up learning by other processes, so that scoring never waits
+# on storage once they are loaded.
+
+import logging
+import math
+import threading
+import time
+from collections import Counter
+
+DEF_REFRESH_INTERVAL = 300
+
+
+class WordCounts(object):
+    def __init__(self, load, refresh_interval=DEF_REFRESH_INTERVAL):
+        # load returns the stored word and stem counts
+        self.load = load
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.words = Counter()
+        self.stems = Counter()
+        self.total = 0
+        self.loaded = None
+        self.refreshing = False
+
+    def refresh(self):
+        words, stems = self.load()
+        with self.lock:
+            self.words = Counter(words)
+            self.stems = Counter(stems)
+            self.total = sum(self.words.values())
+            self.loaded = time.time()
+
+    def ensure_loaded(self):
+        if self.loaded is None:
+            self.refresh()
+        return self
+
+    def maybe_refresh(self):
+        # the old counts are used until the reload finishes
+        with self.lock:
+            if (self.loaded is None or not self.refresh_interval or
+                    self.refreshing or
+                    time.time() - self.loaded <= self.refresh_interval):
+                return
+            self.refreshing = True
+        threading.Thread(target=self.reload, daemon=True).start()
+
+    def reload(self):
+        try:
+            self.refresh()
+        except Exception:
+            logging.exception("Failed to reload word counts")
+            self.loaded = time.time()
+        finally:
+            self.refreshing = False
+
+    def add(self, words, stems):
+        # counts not loaded yet will include these when they are
+        with self.lock:
+            if self.loaded is not None:
+                self.words.update(words)
+                self.stems.update(stems)
+                self.total += sum(words.values())
+
+    def word(self, word):
+        return self.ensure_loaded().words.get(word, 0)
+
+    def stem(self, stem):
+        return self.ensure_loaded().stems.get(stem, 0)
+
+    def most_common_stems(self, count):
+        return self.ensure_loaded().stems.most_common(count)
+
+    def idf(self, count):
+        return math.log((1 + self.ensure_loaded().total) / (1 + count))
@@ -0,0 +1,128 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Keeping several brains open at once.
+#
+# A registry opens brains by name on first use and keeps them, with their
+# caches, counts and reply pools, until they have been idle for too long or
+# more than a set number are open, when the least recently used are closed.
+# Brains that are in use are never closed. The factory decides how brains
+# are opened, which is where they can be given a shared database
+# connection.
+
+import contextlib
+import threading
+import time
+from collections import OrderedDict
+
+from kimchi.stats import metrics
+
+DEF_MAX_BRAINS = 32
+
+
+class BrainRegistry(object):
+    def __init__(self, factory, max_brains=DEF_MAX_BRAINS, idle_timeout=None):
+        self.factory = factory
+        self.max_brains = max_brains
+        self.idle_timeout = idle_timeout
+        # brains by name, least recently used first
+        self.brains = OrderedDict()
+        self.users = {}
+        self.last_used = {}
+        # the registry lock only guards the bookkeeping, while brains are
+        # opened under a lock of their own so that others can still be used
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.loaded = 0
+        self.evicted = 0
+
+    def __contains__(self, name):
+        return name in self.brains
+
+    def __len__(self):
+        return len(self.brains)
+
+    @contextlib.contextmanager
+    def use(self, name, **kwargs):
+        # the brain is held open until the block ends
+        with self.lock:
+            self.users[name] = self.users.get(name, 0) + 1
+            loading = self.loading.setdefault(name, threading.Lock())
+        try:
+            with loading:
+                brain = self.brains.get(name)
+                if brain is None:
+                    with metrics.phase('brain_load'):
+                        brain = self.factory(name, **kwargs)
+                    with self.lock:
+                        self.brains[name] = brain
+                        self.loaded += 1
+            with self.lock:
+                self.brains.move_to_end(name)
+            yield brain
+        finally:
+            with self.lock:
+                self.users[name] -= 1
+                self.last_used[name] = time.time()
+                if name not in self.brains and not self.users[name]:
+                    # the brain failed to open
+                    self.remove(name)
+                evicted = self.evictable()
+            for brain in evicted:
+                brain.close()
+
+    def get(self, name, **kwargs):
+        with self.use(name, **kwargs) as brain:
+            return brain
+
+    def evictable(self):
+        # removes and returns the brains to close, called with the lock held
+        idle = [name for name in self.brains if not self.users.get(name)]
+        if self.idle_timeout is not None:
+            cutoff = time.time() - self.idle_timeout
+            expired = [name for name in idle if self.last_used[name] < cutoff]
+        else:
+            expired = []
+        excess = len(self.brains) - len(expired) - self.max_brains
+        expired.extend([name for name in idle
+                        if name not in expired][:max(0, excess)])
+        self.evicted += len(expired)
+        return [self.remove(name) for name in expired]
+
+    def remove(self, name):
+        self.users.pop(name, None)
+        self.last_used.pop(name, None)
+        self.loading.pop(name, None)
+        return self.brains.pop(name, None)
+
+    def reply(self, name, msg, **kwargs):
+        with self.use(name) as brain:
+            return brain.generate_replies(msg, **kwargs)
+
+    def learn(self, name, msg):
+        with self.use(name) as brain:
+            return brain.learn(msg)
+
+    def stats(self):
+        return {
+            'open': len(self.brains),
+            'loaded': self.loaded,
+            'evicted': self.evicted,
+        }
+
+    def close(self):
+        with self.lock:
+            brains = [self.remove(name) for name in list(self.brains)]
+        for brain in brains:
+            brain.close()
@@ -0,0 +1,185 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reply scoring.
+#
+# A candidate reply is a reverse chain read backwards followed by a forward
+# chain from the same node, less the node's first word which starts both.
+# Rather than building and scoring every pairing, the length statistics and
+# novel words of each chain are worked out once, all pairings are scored
+# together and only the best few replies are assembled. The number of novel
+# words in a pairing is the size of the union of the two chains' novel
+# words, which is found for every pairing at once from the product of their
+# word incidence matrices. numpy is used when it is installed.
+
+import heapq
+import random
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TOP_REPLIES = 10
+
+
+class Candidates(object):
+    # the best replies found so far and how many have been considered
+    def __init__(self, top=TOP_REPLIES, replies=(), count=0):
+        self.top = top
+        self.replies = list(replies)
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, other):
+        self.count += other.count
+        self.replies = heapq.nlargest(self.top, self.replies + other.replies,
+                                      key=itemgetter(0))
+
+    def best(self):
+        return sorted(self.replies, key=itemgetter(0), reverse=True)
+
+    def choice(self):
+        if self.replies:
+            return random.choice(self.replies)[1]
+
+
+def chain_stats(chains):
+    return ([sum(len(w) for w in chain) for chain in chains],
+            [len(chain) for chain in chains],
+            [max([len(w) for w in chain], default=0) for chain in chains])
+
+
+class Scorer(object):
+    # scores replies by longest word x average word length x the number of
+    # words not in the original message; subclasses can weight the words
+    # or combine the statistics differently
+    def __init__(self, top=TOP_REPLIES):
+        self.top = top
+
+    def weight(self, word):
+        return 1.0
+
+    def combine(self, longest, average, novelty):
+        return longest * average * novelty
+
+    def weights(self, words, original):
+        return [0.0 if w in original else self.weight(w) for w in words]
+
+    def score(self, words, original):
+        if not words:
+            return 0.0
+        original = set(original)
+        novelty = sum(self.weights(set(words), original))
+        return self.combine(max(len(w) for w in words),
+                            sum(len(w) for w in words) / len(words), novelty)
+
+    def rank(self, replies, original):
+        # rescores ready-made replies against a message
+        scored = ((self.score(words, original), words) for words in replies)
+        return Candidates(self.top, heapq.nlargest(self.top, scored,
+                                                   key=itemgetter(0)),
+                          len(replies))
+
+    def join(self, forward_chains, reverse_chains, original, top=None):
+        top = top or self.top
+        if not forward_chains or not reverse_chains:
+            return Candidates(top)
+        original = set(original)
+        forward_parts = [chain[1:] for chain in forward_chains]
+        words = {}
+        for chain in reverse_chains + forward_parts:
+            for word in chain:
+                words.setdefault(word, len(words))
+        weights = self.weights(words, original)
+        pairings = (self.numpy_top if numpy is not None
+                    else self.python_top)(reverse_chains, forward_parts,
+                                          words, weights, top)
+        replies = [(score, reverse_chains[r][::-1] + forward_parts[f])
+                   for score, r, f in pairings]
+        return Candidates(top, replies,
+                          len(reverse_chains) * len(forward_parts))
+
+    def numpy_top(self, reverse_chains, forward_parts, words, weights, top):
+        def incidence(chains):
+            matrix = numpy.zeros((len(chains), len(words)))
+            for i, chain in enumerate(chains):
+                matrix[i, [words[w] for w in chain]] = 1.0
+            return matrix
+
+        weights = numpy.array(weights)
+        reverse, forward = incidence(reverse_chains), incidence(forward_parts)
+        novelty = ((reverse @ weights)[:, None] + (forward @ weights)[None, :]
+                   - (reverse * weights) @ forward.T)
+        r_total, r_count, r_longest = map(numpy.array,
+                                          chain_stats(reverse_chains))
+        f_total, f_count, f_longest = map(numpy.array,
+                                          chain_stats(forward_parts))
+        count = numpy.maximum(r_count[:, None] + f_count[None, :], 1)
+        scores = self.combine(
+            numpy.maximum(r_longest[:, None], f_longest[None, :]),
+            (r_total[:, None] + f_total[None, :]) / count, novelty).ravel()
+        k = min(top, scores.size)
+        best = numpy.argpartition(scores, scores.size - k)[scores.size - k:]
+        return [(float(scores[i]),) + divmod(int(i), len(forward_parts))
+                for i in best]
+
+    def python_top(self, reverse_chains, forward_parts, words, weights, top):
+        def word_sets(chains):
+            return [{words[w] for w in chain} for chain in chains]
+
+        reverse_sets, forward_sets = (word_sets(reverse_chains),
+                                      word_sets(forward_parts))
+        reverse_stats = list(zip(*chain_stats(reverse_chains)))
+        forward_stats = list(zip(*chain_stats(forward_parts)))
+
+        def scores():
+            for r, (r_total, r_count, r_longest) in enumerate(reverse_stats):
+                for f, (f_total, f_count, f_longest) in enumerate(
+                        forward_stats):
+                    novelty = sum(weights[w]
+                                  for w in reverse_sets[r] | forward_sets[f])
+                    score = self.combine(
+                        max(r_longest, f_longest),
+                        (r_total + f_total) / max(r_count + f_count, 1),
+                        novelty)
+                    yield score, r, f
+
+        return heapq.nlargest(top, scores(), key=itemgetter(0))
+
+
+class RarityScorer(Scorer):
+    # words used less in the brain count for more
+    def __init__(self, word_count, top=TOP_REPLIES):
+        super(RarityScorer, self).__init__(top)
+        self.word_count = word_count
+
+    def weight(self, word):
+        return 1.0 / max(1, self.word_count(word))
+
+
+class IDFScorer(RarityScorer):
+    # novel words are weighted by their inverse document frequency
+    def __init__(self, word_count, idf, top=TOP_REPLIES):
+        super(IDFScorer, self).__init__(word_count, top)
+        self.idf = idf
+
+    def weight(self, word):
+        return self.idf(self.word_count(word))
+
+
+SCORERS = ('length', 'rarity', 'idf')
@@ -0,0 +1,272 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A long-running reply server.
+#
+# Brains are opened once per database and kept warm between requests, up
+# to a limit after which the least recently used are closed.
+# Each connection is read on its own thread, closed once idle for a while,
+# and its requests are handled on a fixed pool of worker threads, either as
+# HTTP (POST /reply, /learn or /stats with JSON bodies) or as
+# newline-delimited JSON objects with an "op" of "reply", "learn", "stats"
+# or "metrics", one response line per request line. Learned messages are
+# queued and written in batches by a BufferedLearner per brain, so learning
+# never holds up a reply. Requests may only name the served brain and those
+# it is configured to allow.
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+
+from kimchi.registry import DEF_MAX_BRAINS, BrainRegistry
+from kimchi.stats import metrics
+
+DEF_HOST = '127.0.0.1'
+DEF_PORT = 8530
+DEF_WORKERS = 16
+DEF_IDLE_TIMEOUT = 60
+PROTOCOLS = ('http', 'jsonl')
+
+
+class RequestError(Exception):
+    pass
+
+
+class ServedBrain(object):
+    def __init__(self, brain, shared=True, learn_queue=None, precompute=0,
+                 compaction=None):
+        self.brain = brain
+        # brains held in this process are not safe to read while they are
+        # written, whereas a database server takes care of that itself
+        self.lock = contextlib.nullcontext() if shared else threading.Lock()
+        kwargs = {'queue_size': learn_queue} if learn_queue else {}
+        self.learner = brain.buffer_learning(lock=self.lock, **kwargs)
+        if precompute:
+            brain.precompute_replies(precompute, lock=self.lock)
+        if compaction:
+            brain.schedule_compaction(lock=self.lock, **compaction)
+
+    def reply(self, msg, deadline=None):
+        with self.lock:
+            return self.brain.generate_replies(msg, deadline=deadline)
+
+    def learn(self, msgs):
+        for msg in msgs:
+            self.brain.learn(msg)
+        return len(msgs)
+
+    def stats(self):
+        return {
+            'cache': self.brain.cache_stats(),
+            'learner': self.learner.stats(),
+            'pools': self.brain.pools.stats(),
+            'compaction': (self.brain.compactor.stats()
+                           if self.brain.compactor is not None else None),
+        }
+
+    def close(self):
+        self.brain.close()
+
+
+class ReplyService(object):
+    def __init__(self, factory, dbname, reply_timeout=None, shared=True,
+                 learn_queue=None, precompute=0, compaction=None,
+                 max_brains=DEF_MAX_BRAINS, idle_timeout=None,
+                 allowed=(), allow_any=False):
+        self.factory = factory
+        self.dbname = dbname
+        self.allowed = set(allowed) | {dbname}
+        self.allow_any = allow_any
+        self.reply_timeout = reply_timeout
+        self.shared = shared
+        self.learn_queue = learn_queue
+        self.precompute = precompute
+        self.compaction = compaction
+        self.brains = BrainRegistry(self.serve, max_brains, idle_timeout)
+
+    def serve(self, dbname):
+        return ServedBrain(self.factory(dbname), self.shared,
+                           self.learn_queue, self.precompute, self.compaction)
+
+    def get(self, dbname=None):
+        return self.brains.get(dbname or self.dbname)
+
+    def handle(self, op, request):
+        if not isinstance(request, dict):
+            raise RequestError("requests must be JSON objects")
+        with self.brains.use(self.brain_name(request)) as served:
+            return self.handle_brain(served, op, request)
+
+    def brain_name(self, request):
+        dbname = request.get('dbname') or self.dbname
+        # names become file names for brains held in this process
+        if (not isinstance(dbname, str) or '..' in dbname or
+                '/' in dbname or os.sep in dbname or
+                (os.altsep and os.altsep in dbname)):
+            raise RequestError("invalid brain name")
+        if not self.allow_any and dbname not in self.allowed:
+            raise RequestError("unknown brain {0}".format(dbname))
+        return dbname
+
+    def handle_brain(self, served, op, request):
+        if op == 'reply':
+            timeout = self.timeout(request)
+            deadline = time.time() + timeout if timeout else None
+            return {'reply': served.reply(self.message(request),
+                                          deadline=deadline)}
+        if op == 'learn':
+            msgs = request.get('messages')
+            if msgs is None:
+                msgs = [self.message(request)]
+            elif (not isinstance(msgs, list) or
+                    not all(isinstance(msg, str) for msg in msgs)):
+                raise RequestError("messages must be a list of strings")
+            return {'queued': served.learn(msgs)}
+        if op == 'stats':
+            return dict(served.stats(), brains=self.brains.stats())
+        if op == 'metrics':
+            return metrics.snapshot()
+        raise RequestError("unknown operation {0}".format(op))
+
+    def message(self, request):
+        msg = request.get('message')
+        if not isinstance(msg, str):
+            raise RequestError("a message is required")
+        return msg
+
+    def timeout(self, request):
+        timeout = request.get('timeout')
+        if timeout is None:
+            return self.reply_timeout
+        if (isinstance(timeout, bool) or
+                not isinstance(timeout, (int, float)) or not timeout > 0):
+            raise RequestError("timeout must be a positive number")
+        return timeout
+
+    def close(self):
+        self.brains.close()
+
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    timeout = DEF_IDLE_TIMEOUT
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def do_GET(self):
+        # metrics for Prometheus to scrape
+        if self.path.strip('/') != 'metrics':
+            self.send_error(404)
+            return
+        data = metrics.prometheus().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf8'))
+            code, resp = 200, self.server.dispatch(
+                self.path.strip('/'), request)
+        except (ValueError, RequestError) as e:
+            code, resp = 400, {'error': str(e)}
+        except Exception as e:
+            logging.exception("Request failed")
+            code, resp = 500, {'error': str(e)}
+        data = json.dumps(resp).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class LineHandler(socketserver.StreamRequestHandler):
+    timeout = DEF_IDLE_TIMEOUT
+
+    def handle(self):
+        try:
+            for line in self.rfile:
+                self.handle_line(line)
+        except socket.timeout:
+            logging.debug("Closing idle connection")
+
+    def handle_line(self, line):
+        if not line.strip():
+            return
+        try:
+            request = json.loads(line.decode('utf8'))
+            resp = self.server.dispatch(
+                request.get('op') if isinstance(request, dict) else None,
+                request)
+        except (ValueError, RequestError) as e:
+            resp = {'error': str(e)}
+        except Exception as e:
+            logging.exception("Request failed")
+            resp = {'error': str(e)}
+        self.wfile.write(json.dumps(resp).encode('utf8') + b'\n')
+        self.wfile.flush()
+
+
+class PoolMixIn(socketserver.ThreadingMixIn):
+    # connections are read on a thread each, as with ThreadingMixIn, but
+    # their requests are handled by a fixed pool of worker threads so that
+    # idle connections never hold up requests on others
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def start_workers(self, workers):
+        self.workers = ThreadPoolExecutor(max_workers=workers)
+
+    def dispatch(self, op, request):
+        return self.workers.submit(self.service.handle, op,
+                                   request).result()
+
+    def server_close(self):
+        super(PoolMixIn, self).server_close()
+        self.workers.shutdown(wait=False)
+
+
+class TCPServer(PoolMixIn, socketserver.TCPServer):
+    pass
+
+
+class UnixServer(PoolMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+def make_server(service, protocol='http', host=DEF_HOST, port=DEF_PORT,
+                unix_socket=None, workers=DEF_WORKERS):
+    handler = HTTPHandler if protocol == 'http' else LineHandler
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixServer(unix_socket, handler)
+    else:
+        server = TCPServer((host, port), handler)
+    server.service = service
+    server.start_workers(workers)
+    return server
@@ -0,0 +1,168 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Brain snapshots.
+#
+# A snapshot is a gzipped file of JSON records, one per line. The first
+# holds the brain's control info, and the rest hold batches of nodes,
+# links, word and stem counts and the reply pools. Words are numbered in
+# the order they first appear and written out in "words" records ahead of
+# the records that use them. Nodes are numbered in the order they are
+# written, and links refer to nodes by number. Nodes and links carry how
+# often they were learned and when they were last seen. Both export and
+# import work through a batch at a time, keeping only the word table and a
+# number for each node in memory.
+#
+# Importing into a brain that already has chains merges the snapshot into
+# it the same way learning does: nodes keep their smallest distances, links
+# are added and counts are added to.
+
+import gzip
+import json
+from collections import Counter
+from itertools import islice
+
+from kimchi.chunker import Chunker
+
+VERSION = 1
+DEF_BATCH_SIZE = 10000
+SNAPSHOT_SUFFIX = '.kimchi.gz'
+# control info that must agree for a snapshot to be merged into a brain
+MODEL_INFO = ('chainorder', 'stop', 'stemmer')
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+def write_record(f, record):
+    f.write(json.dumps(record, separators=(',', ':')).encode('utf8'))
+    f.write(b'\n')
+
+
+def export_brain(backend, path, batch_size=DEF_BATCH_SIZE):
+    words = {}
+
+    def word_ids(batch, new):
+        ids = []
+        for word in batch:
+            wid = words.get(word)
+            if wid is None:
+                wid = words[word] = len(words)
+                new.append(word)
+            ids.append(wid)
+        return ids
+
+    def write_batch(f, kind, batch, make_record):
+        new = []
+        record = make_record(batch, new)
+        if new:
+            write_record(f, {'words': new})
+        write_record(f, {kind: record})
+
+    def node_records(batch, new):
+        records = []
+        for handle, doc in batch:
+            node_ids[handle] = len(node_ids)
+            records.append([word_ids(doc['node'], new),
+                            word_ids([doc['base_word_stem']], new)[0],
+                            doc['outbound_distance'],
+                            doc['inbound_distance'],
+                            doc.get('count'), doc.get('seen')])
+        return records
+
+    def count_records(batch, new):
+        return [list(pair) for pair in
+                zip(word_ids([word for word, count in batch], new),
+                    [count for word, count in batch])]
+
+    node_ids = {}
+    edge_count = 0
+    with gzip.open(path, 'wb') as f:
+        write_record(f, {'snapshot': VERSION, 'info': backend.load_info()})
+        for batch in batched(backend.iter_nodes(), batch_size):
+            write_batch(f, 'nodes', batch, node_records)
+        for batch in batched(backend.iter_links(), batch_size):
+            write_record(f, {'links': [[node_ids[from_handle],
+                                        node_ids[to_handle], count, seen]
+                                       for from_handle, to_handle, count, seen
+                                       in batch]})
+            edge_count += len(batch)
+        for kind, counts in zip(('word_counts', 'stem_counts'),
+                                backend.load_counts()):
+            for batch in batched(counts.items(), batch_size):
+                write_batch(f, kind, batch, count_records)
+        pools = backend.load_pools()
+        if pools:
+            write_record(f, {'pools': pools})
+    return len(node_ids), edge_count
+
+
+def import_brain(backend, path):
+    with gzip.open(path, 'rb') as f:
+        header = json.loads(f.readline() or 'null')
+        if not isinstance(header, dict) or header.get('snapshot') != VERSION:
+            raise ValueError("{0} is not a brain snapshot".format(path))
+        info = header['info']
+        for key in MODEL_INFO:
+            if backend.get_or_set_info(key, info[key]) != info[key]:
+                raise ValueError("the brain's {0} does not match the "
+                                 "snapshot's".format(key))
+        for key, value in info.items():
+            if key not in MODEL_INFO:
+                backend.set_info(key, value)
+        chunker = Chunker(info['chainorder'], info['stop'], info['stemmer'])
+
+        words = []
+        handles = []
+        edge_count = 0
+        for line in f:
+            record = json.loads(line)
+            if 'words' in record:
+                words.extend(record['words'])
+            elif 'nodes' in record:
+                nodes = [tuple(words[w] for w in node)
+                         for node, stem, outbound, inbound, count, seen
+                         in record['nodes']]
+                keys = chunker.node_keys(nodes)
+                docs = {key: {
+                    '_key': key,
+                    'base_word_stem': words[stem],
+                    'node': node,
+                    'outbound_distance': outbound,
+                    'inbound_distance': inbound,
+                    'count': count,
+                    'seen': seen,
+                } for key, node, (_, stem, outbound, inbound, count, seen)
+                    in zip(keys, nodes, record['nodes'])}
+                imported = backend.import_nodes(docs)
+                backend.add_prefixes(chunker.index_prefixes(
+                    docs.values(), imported.values()))
+                handles.extend(imported[key] for key in keys)
+            elif 'links' in record:
+                backend.import_edges(
+                    (handles[from_id], handles[to_id], count, seen)
+                    for from_id, to_id, count, seen in record['links'])
+                edge_count += len(record['links'])
+            elif 'word_counts' in record:
+                backend.add_counts(Counter({words[w]: count for w, count
+                                            in record['word_counts']}),
+                                   Counter())
+            elif 'stem_counts' in record:
+                backend.add_counts(Counter(), Counter(
+                    {words[w]: count for w, count in record['stem_counts']}))
+            elif 'pools' in record:
+                backend.store_pools(record['pools'])
+    return len(handles), edge_count
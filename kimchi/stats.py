@@ -0,0 +1,147 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Counters and latency histograms for HTTP requests and brain phases.
+#
+# Metrics are recorded into a process-wide registry once it is enabled, and
+# cost a single check otherwise. They can be read as a dict or written in
+# the Prometheus text format.
+
+import bisect
+import contextlib
+import threading
+import time
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip(self.buckets + ('+Inf',),
+                                    self.counts))}
+
+
+class Metrics(object):
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def phase(self, phase):
+        return self.timer('kimchi_phase_seconds', phase=phase)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(key), 'value': value}
+                    for (name, key), value in sorted(self.counters.items())],
+                'histograms': [
+                    dict(histogram.snapshot(), name=name, labels=dict(key))
+                    for (name, key), histogram in
+                    sorted(self.histograms.items())],
+            }
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            seen = set()
+            for (name, key), value in sorted(self.counters.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append('# TYPE {0} counter'.format(name))
+                lines.append('{0}{1} {2}'.format(name, format_labels(key),
+                                                 value))
+            for (name, key), histogram in sorted(self.histograms.items()):
+                if name not in seen:
+                    seen.add(name)
+                    lines.append('# TYPE {0} histogram'.format(name))
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',),
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, format_labels(key, [('le', bound)]),
+                        cumulative))
+                lines.append('{0}_sum{1} {2}'.format(
+                    name, format_labels(key), histogram.sum))
+                lines.append('{0}_count{1} {2}'.format(
+                    name, format_labels(key), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def enable():
+    metrics.enabled = True
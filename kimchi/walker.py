@@ -0,0 +1,48 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Randomised chain walking.
+#
+# Rather than enumerating every path from a node, sample_chains takes
+# random walks towards the stop token, guided by each node's stored
+# distance to the end of a message, until it has found enough distinct
+# complete paths. Neighbours are only asked for as the walks reach them.
+
+import random
+
+DEF_CHAIN_SAMPLES = 10
+WALKS_PER_SAMPLE = 3
+
+
+def sample_chains(handle, neighbours, distance, first_word, stop_word,
+                  max_length, samples=DEF_CHAIN_SAMPLES):
+    # neighbours(node) gives the nodes linked in the walk direction and
+    # distance(node) the stored number of nodes from it to a stop node
+    paths = set()
+    for walk in range(samples * WALKS_PER_SAMPLE):
+        path = [handle]
+        while first_word(path[-1]) != stop_word:
+            # only step to nodes known to reach a stop within max_length
+            candidates = [n for n in neighbours(path[-1])
+                          if n not in path and
+                          len(path) + distance(n) <= max_length + 1]
+            if not candidates:
+                break
+            weights = [1.0 / max(distance(n), 1) for n in candidates]
+            path.append(random.choices(candidates, weights)[0])
+        else:
+            paths.add(tuple(path[:-1]))
+            if len(paths) >= samples:
+                break
+    return [list(path) for path in paths]
@@ -0,0 +1,41 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from kimchi import bench
+
+DEF_LINES = 150
+
+
+def corpus(lines=DEF_LINES, seed=0):
+    return [line.strip() for line in bench.synthetic_corpus(
+        lines, vocabulary=40, skew=1.1, max_words=8, seed=seed)]
+
+
+def graph(backend):
+    # the nodes and links of a brain by their words rather than handles,
+    # which differ between backends and learning orders
+    docs = dict(backend.iter_nodes())
+    words = {handle: tuple(doc['node']) for handle, doc in docs.items()}
+    nodes = {words[handle]: (doc['base_word_stem'],
+                             doc['outbound_distance'],
+                             doc['inbound_distance'])
+             for handle, doc in docs.items()}
+    links = {(words[from_handle], words[to_handle]): count
+             for from_handle, to_handle, count, seen in backend.iter_links()}
+    return nodes, links
+
+
+def usage(backend):
+    return {tuple(doc['node']): doc.get('count')
+            for handle, doc in backend.iter_nodes()}
@@ -0,0 +1,89 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A compiled brain must hold the same chains as the brain it came from.
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from kimchi.backends import MemoryBackend
+from kimchi.compiled import CompiledBackend, compile_brain
+from kimchi.kimchicli import MAX_REPLY_LENGTH, Brain
+from tests import corpus, graph
+
+
+class CompiledTests(unittest.TestCase):
+    def setUp(self):
+        datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, datadir)
+        self.brain = Brain(backend=MemoryBackend(
+            path=os.path.join(datadir, 'source.brain')))
+        self.brain.learn_batch(corpus())
+        path = os.path.join(datadir, 'source.kmc')
+        info = {
+            'chainorder': self.brain.chainorder,
+            'stop': self.brain.stop,
+            'stemmer': self.brain.stemmer_type,
+            'walker': self.brain.walker,
+        }
+        self.counts = compile_brain(self.brain.backend, info, path)
+        self.compiled = CompiledBackend(path=path)
+        self.addCleanup(self.compiled.close)
+
+    def test_counts(self):
+        source = self.brain.backend
+        self.assertEqual(self.counts, (len(list(source.iter_nodes())),
+                                       len(list(source.iter_edges()))))
+
+    def test_same_graph(self):
+        source_nodes, source_links = graph(self.brain.backend)
+        nodes, links = graph(self.compiled)
+        self.assertEqual(nodes, source_nodes)
+        self.assertEqual(set(links), set(source_links))
+
+    def test_same_counts_and_info(self):
+        self.assertEqual(self.compiled.load_counts(),
+                         self.brain.backend.load_counts())
+        for key in ('chainorder', 'stop', 'stemmer', 'walker'):
+            self.assertEqual(self.compiled.get_info(key),
+                             self.brain.backend.get_info(key))
+
+    def test_same_chains(self):
+        source = self.brain.backend
+        words = {tuple(doc['node']): handle
+                 for handle, doc in source.iter_nodes()}
+        for handle, doc in self.compiled.iter_nodes():
+            for direction in ('outbound', 'inbound'):
+                self.assertEqual(
+                    sorted(self.compiled.word_chains(
+                        handle, direction, self.brain.stop,
+                        MAX_REPLY_LENGTH)),
+                    sorted(source.word_chains(
+                        words[tuple(doc['node'])], direction,
+                        self.brain.stop, MAX_REPLY_LENGTH)))
+
+    def test_same_seeds(self):
+        source = self.brain.backend
+        for stem in ('word0', 'word1', 'word2'):
+            handles = self.compiled.nodes_by_stem(stem, 1000)
+            self.assertTrue(handles)
+            self.assertEqual(len(handles),
+                             len(source.nodes_by_stem(stem, 1000)))
+
+    def test_read_only(self):
+        with self.assertRaises(io.UnsupportedOperation):
+            self.compiled.add_counts({'word0': 1}, {'word0': 1})
@@ -0,0 +1,95 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Serial, batched and parallel learning must give the same brain.
+
+import os
+import shutil
+import tempfile
+import unittest
+from itertools import count
+
+from kimchi.backends import MemoryBackend
+from kimchi.fakearango import FakeArangoServer
+from kimchi.kimchicli import Brain, learn_parallel
+from tests import corpus, graph, usage
+
+BATCH_SIZE = 40
+WORKERS = 3
+
+
+class LearningTests(object):
+    def contents(self, brain):
+        return graph(brain.backend), usage(brain.backend), \
+            brain.backend.load_counts()
+
+    def learned(self, learn):
+        brain = self.open_brain()
+        self.addCleanup(brain.close)
+        lines = corpus()
+        learn(brain, [lines[i:i + BATCH_SIZE]
+                      for i in range(0, len(lines), BATCH_SIZE)])
+        return self.contents(brain)
+
+    def learn_serial(self, brain, batches):
+        for batch in batches:
+            for line in batch:
+                brain.learn(line)
+
+    def learn_batches(self, brain, batches):
+        for batch in batches:
+            brain.learn_batch(batch)
+
+    def learn_parallel(self, brain, batches):
+        learn_parallel(brain, iter(batches), WORKERS)
+
+    def test_serial_learns_every_line(self):
+        nodes, links = self.learned(self.learn_serial)[0]
+        self.assertTrue(nodes)
+        self.assertTrue(links)
+
+    def test_batches_match_serial(self):
+        self.assertEqual(self.learned(self.learn_serial),
+                         self.learned(self.learn_batches))
+
+    def test_parallel_matches_serial(self):
+        self.assertEqual(self.learned(self.learn_serial),
+                         self.learned(self.learn_parallel))
+
+
+class MemoryLearningTests(LearningTests, unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+        self.names = count()
+
+    def open_brain(self):
+        path = os.path.join(self.datadir,
+                            'brain{0}.brain'.format(next(self.names)))
+        return Brain(backend=MemoryBackend(path=path))
+
+
+class ArangoLearningTests(LearningTests, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeArangoServer().start()
+        cls.names = count()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def open_brain(self):
+        return Brain('brain{0}'.format(next(self.names)),
+                     url=self.server.url)
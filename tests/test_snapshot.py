@@ -0,0 +1,81 @@
+# Copyright 2015 Gary Martin
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Exporting a brain and importing it elsewhere must give the same brain.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from kimchi.backends import ArangoBackend, MemoryBackend
+from kimchi.fakearango import FakeArangoServer
+from kimchi.kimchicli import Brain
+from kimchi.snapshot import MODEL_INFO, export_brain, import_brain
+from tests import corpus, graph, usage
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.datadir)
+        self.brain = Brain(backend=self.memory_backend('source'),
+                           chainorder=3)
+        self.brain.learn_batch(corpus())
+        self.snapshot = os.path.join(self.datadir, 'source.kimchi.gz')
+        export_brain(self.brain.backend, self.snapshot)
+
+    def memory_backend(self, name):
+        return MemoryBackend(path=os.path.join(self.datadir, name + '.brain'))
+
+    def contents(self, backend):
+        info = backend.load_info()
+        return (graph(backend), usage(backend), backend.load_counts(),
+                {key: info.get(key) for key in MODEL_INFO})
+
+    def assertImported(self, backend):
+        nodes, edges = import_brain(backend, self.snapshot)
+        source = self.brain.backend
+        self.assertEqual(nodes, len(list(source.iter_nodes())))
+        self.assertEqual(edges, len(list(source.iter_edges())))
+        self.assertEqual(self.contents(backend), self.contents(source))
+
+    def test_memory_round_trip(self):
+        self.assertImported(self.memory_backend('copy'))
+
+    def test_round_trip_through_saving(self):
+        backend = self.memory_backend('copy')
+        import_brain(backend, self.snapshot)
+        backend.close()
+        self.assertEqual(self.contents(self.memory_backend('copy')),
+                         self.contents(self.brain.backend))
+
+    def test_arango_round_trip(self):
+        server = FakeArangoServer().start()
+        self.addCleanup(server.stop)
+        self.assertImported(ArangoBackend('copy', url=server.url))
+
+    def test_mismatched_model_is_refused(self):
+        backend = self.memory_backend('copy')
+        backend.get_or_set_info('chainorder', 2)
+        with self.assertRaises(ValueError):
+            import_brain(backend, self.snapshot)
+
+    def test_imported_brain_replies(self):
+        backend = self.memory_backend('copy')
+        import_brain(backend, self.snapshot)
+        brain = Brain(backend=backend)
+        self.assertEqual(brain.chainorder, 3)
+        word = corpus()[0].split()[0]
+        self.assertTrue(brain.get_nodes_by_first_word(word))